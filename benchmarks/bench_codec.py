@@ -0,0 +1,130 @@
+"""
+bench_codec.py : Decode time, memory and transfer size of API payloads per codec
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import gc
+import gzip
+import json
+import time
+import tracemalloc
+import zlib
+from pathlib import Path
+
+from benchmarks.fake_eve import Store
+from epmanage.lib.codec import orjson, msgpack, Codec, ItemScanner
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def make_page(agents: int, inventory_size: int) -> bytes:
+    """A collection page holding every agent, as the stand-in server sends it"""
+    store = Store(agents, 0, 0, inventory_size)
+    items = store.collections['agent']
+    return json.dumps(dict(
+        _items=items,
+        _links=dict(self=dict(title='agent', href='agent')),
+        _meta=dict(page=1, max_results=len(items), total=len(items)))).encode()
+
+
+def measure(func, repeat: int) -> float:
+    """Best time of `repeat` runs, in milliseconds (garbage collection off, as timeit does)"""
+    best = None
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        gc.enable()
+    return best * 1000
+
+
+def allocation_peak(func) -> int:
+    """Peak of the memory allocated by one run, in kB"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def stream_decode(body: bytes, chunk_size: int) -> int:
+    """Decode the items the way ItemStream does, dropping each one as a consumer would"""
+    scanner = ItemScanner()
+    count = 0
+    for start in range(0, len(body), chunk_size):
+        count += len(scanner.feed(body[start:start + chunk_size]))
+    return count + len(scanner.close())
+
+
+def run(name: str, body: bytes, repeat: int, chunk_size: int):
+    doc = json.loads(body)
+    print('{} ({:,} bytes, {} items)'.format(name, len(body), len(doc.get('_items', []))))
+
+    decoders = [('json', body, json.loads)]
+    if orjson:
+        decoders.append(('orjson', body, orjson.loads))
+    if msgpack:
+        decoders.append(('msgpack', msgpack.packb(doc), lambda x: msgpack.unpackb(x, raw=False)))
+    for codec_name, data, loads in decoders:
+        print('  decode {:<10} {:>12,} bytes {:>9.2f} ms'.format(codec_name, len(data), measure(
+            lambda: loads(data), repeat)))
+
+    compressions = [
+        ('gzip', gzip.compress(body, 6), gzip.decompress),
+        ('deflate', zlib.compress(body, 6), zlib.decompress),
+    ]
+    if brotli:
+        compressions.append(('br', brotli.compress(body, quality=5), brotli.decompress))
+    for codec_name, data, decompress in compressions:
+        print('  {:<17} {:>12,} bytes {:>9.2f} ms'.format(codec_name, len(data), measure(
+            lambda: decompress(data), repeat)))
+
+    # Whole page against streaming (the chunks are sliced from the body: the body itself is not counted)
+    for mode, func in (('loads', lambda: Codec.loads(body)),
+                       ('stream', lambda: stream_decode(body, chunk_size))):
+        print('  {:<17} {:>12,} kB peak {:>6.2f} ms'.format(mode, allocation_peak(func), measure(func, repeat)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('responses', nargs='*', type=Path,
+                        help='Recorded JSON responses (default: a generated agent page)')
+    parser.add_argument('--agents', type=int, default=5000, help='Agents of the generated page')
+    parser.add_argument('--inventory-size', type=int, default=20)
+    parser.add_argument('--save', type=Path, help='Record the generated page in this file')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024, help='Chunks fed to the stream decoder')
+    args = parser.parse_args()
+
+    if args.responses:
+        for path in args.responses:
+            run(str(path), path.read_bytes(), args.repeat, args.chunk_size)
+    else:
+        page = make_page(args.agents, args.inventory_size)
+        if args.save:
+            args.save.write_bytes(page)
+        run('generated page', page, args.repeat, args.chunk_size)
@@ -0,0 +1,89 @@
+"""
+bench_import.py : Startup cost of the command line tool
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Runs a command under `python -X importtime` and fails (exit status 1) when
+its imports take longer than the budget, or when it imports a module which
+should be deferred
+"""
+import argparse
+import re
+import subprocess
+import sys
+
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+# Never needed to start, only by the commands which use them
+DEFERRED = ('requests', 'jwt', 'arrow', 'pandas', 'aiohttp', 'sqlite3')
+
+
+def import_times(args: list) -> list:
+    """(module, self µs, cumulative µs, depth) of every import of a python command"""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    times = []
+    for line in proc.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            times.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2))
+    return times
+
+
+def measure(args: list, repeat: int) -> list:
+    """
+    Import times of the fastest of `repeat` runs of the command.
+    Modules the interpreter imports at startup (site, .pth files...) are left out
+    """
+    startup = {name for name, _, _, _ in import_times(['-c', 'pass'])}
+    best = None
+    for _ in range(repeat):
+        times = [x for x in import_times(['-m', 'epmanage.scripts.cli'] + args) if x[0] not in startup]
+        if best is None or total(times) < total(best):
+            best = times
+    return best
+
+
+def total(times: list) -> int:
+    """Import time of the command, in µs"""
+    return sum(own for _, own, _, _ in times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('command', nargs='*', default=['version'], help='Arguments of the command (default: version)')
+    parser.add_argument('--budget', type=float, default=50, help='Maximum import time, in milliseconds')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports shown')
+    args = parser.parse_args()
+
+    times = measure(args.command, args.repeat)
+    elapsed = total(times) / 1000
+    for name, _, cumulative, _ in sorted(times, key=lambda x: x[2], reverse=True)[:args.top]:
+        print('{:>9.1f} ms  {}'.format(cumulative / 1000, name))
+
+    failed = False
+    deferred = sorted({name for name, _, _, _ in times if name.split('.')[0] in DEFERRED})
+    if deferred and args.command == ['version']:
+        print('Deferred modules imported: {}'.format(', '.join(deferred)))
+        failed = True
+    print('Total {:.1f} ms (budget {:.0f} ms)'.format(elapsed, args.budget))
+    if elapsed > args.budget:
+        failed = True
+    sys.exit(1 if failed else 0)
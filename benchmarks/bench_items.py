@@ -0,0 +1,104 @@
+"""
+bench_items.py : Memory and speed of the item representation
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import gc
+import os
+import time
+import tracemalloc
+from collections import OrderedDict
+
+from benchmarks.fake_eve import SCHEMA, Store
+from epmanage.lib.agent import Agent
+from epmanage.lib.schema import schema_registry
+from epmanage.scripts.commands.agent import format_agent
+from epmanage.scripts.utils.render import Renderer
+
+
+class LegacyAgent(object):
+    """The item as it was: instance dict, fields sorted and copied on every attributes() call"""
+    _model = 'agent'
+
+    def __init__(self, data):
+        self._data = data
+
+    @property
+    def schema(self) -> dict:
+        return schema_registry.get(self._model)
+
+    def attributes(self) -> dict:
+        out = OrderedDict()
+        for prop in sorted(self.schema.keys()):
+            out[prop] = self._data.get(prop)
+        return out
+
+
+def size_of(cls, docs: list) -> float:
+    """Bytes allocated per item wrapping an existing document"""
+    gc.collect()
+    tracemalloc.start()
+    items = [cls(x) for x in docs]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del items
+    return size / len(docs)
+
+
+def timed(func) -> float:
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+
+def render(rows, stream):
+    with Renderer('table', format_agent, format_agent.projection, color=False, stream=stream) as renderer:
+        for row in rows:
+            renderer.row(row)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--items', type=int, default=100000)
+    args = parser.parse_args()
+
+    schema_registry.set(SCHEMA)
+    documents = Store(args.items, 0, 0, 0, packages=0).collections['agent']
+    legacy = [LegacyAgent(x) for x in documents]
+    slotted = [Agent(x) for x in documents]
+
+    print('{:<28} {:>12} {:>12}'.format('', 'legacy', 'slotted'))
+    print('{:<28} {:>12.1f} {:>12.1f}'.format('bytes per item', size_of(LegacyAgent, documents),
+                                              size_of(Agent, documents)))
+    rows = [
+        ('attributes() x{}'.format(args.items),
+         lambda: [x.attributes() for x in legacy], lambda: [x.attributes() for x in slotted]),
+        ('field read x{}'.format(args.items),
+         lambda: [x.attributes()['hostname'] for x in legacy], lambda: [x['hostname'] for x in slotted]),
+    ]
+    with open(os.devnull, 'w') as devnull:
+        rows.append(('table render x{}'.format(args.items),
+                     lambda: render((x.attributes() for x in legacy), devnull), lambda: render(slotted, devnull)))
+        for name, old, new in rows:
+            print('{:<28} {:>10.0f}ms {:>10.0f}ms'.format(name, timed(old) * 1000, timed(new) * 1000))
+
@@ -0,0 +1,49 @@
+"""
+bench_list.py : Sequential vs parallel collection fetch
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import time
+
+from benchmarks.fake_eve import serve_background, base_url
+from epmanage.lib.agent import AgentAPI
+from epmanage.lib.api import req_sess
+
+
+def run(jobs: int, page_size: int) -> float:
+    start = time.perf_counter()
+    count = sum(1 for _ in AgentAPI().iter(max_results=page_size, jobs=jobs))
+    elapsed = time.perf_counter() - start
+    print('jobs={:<3} {:>7} agents in {:7.3f}s ({:,.0f} agents/s)'.format(jobs, count, elapsed, count / elapsed))
+    return elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--agents', type=int, default=5000)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every response')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    server = serve_background(agents=args.agents, inventory_size=5, latency=args.latency)
+    req_sess.base_url = base_url(server)
+    for jobs in args.jobs:
+        run(jobs, args.page_size)
+    server.shutdown()
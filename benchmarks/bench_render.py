@@ -0,0 +1,92 @@
+"""
+bench_render.py : Output rows/sec of each renderer format
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import contextlib
+import os
+import time
+
+import click
+
+from epmanage.scripts.commands.agent import format_agent
+from epmanage.scripts.utils.render import Renderer, FORMATS
+
+
+class TTY(object):
+    """devnull pretending to be a terminal, to measure colored output"""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def __getattr__(self, item):
+        return getattr(self._stream, item)
+
+    def isatty(self):
+        return True
+
+
+def make_rows(count: int) -> list:
+    return [dict(
+        uuid='00000000-0000-0000-0000-{:012d}'.format(i),
+        hostname='host-{:06d}'.format(i),
+        os='windows',
+        osversion='10',
+        tags=[dict(name='system-windows', type='system'), dict(name='team-{}'.format(i % 7), type='user')])
+        for i in range(count)]
+
+
+def legacy(rows: list, stream):
+    """Per-row click.echo calls, as the list commands used to do"""
+    with contextlib.redirect_stdout(stream):
+        for i, attrs in enumerate(rows):
+            click.echo('[{}] '.format(i), nl=False)
+            click.secho('{uuid} '.format(**attrs), nl=False, fg='yellow')
+            click.echo('{hostname} ({os} {osversion}) '.format(**attrs), nl=False)
+            for tag in attrs['tags']:
+                click.echo('[', nl=False)
+                click.secho('{name}'.format(**tag), fg='green' if tag.get('type') == 'system' else 'white', nl=False)
+                click.echo('] ', nl=False)
+            click.echo()
+
+
+def render(rows: list, stream, fmt: str, color: bool):
+    with Renderer(fmt, format_agent, format_agent.projection, color=color, stream=stream) as renderer:
+        for row in rows:
+            renderer.row(row)
+
+
+def measure(name: str, func, rows: list):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print('{:<16} {:>12,.0f} rows/s'.format(name, len(rows) / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    data = make_rows(args.rows)
+    with open(os.devnull, 'w') as devnull:
+        measure('legacy echo', lambda: legacy(data, devnull), data)
+        measure('table (color)', lambda: render(data, TTY(devnull), 'table', True), data)
+        for output_format in FORMATS:
+            measure(output_format, lambda: render(data, devnull, output_format, False), data)
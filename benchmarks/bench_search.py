@@ -0,0 +1,58 @@
+"""
+bench_search.py : Agent search index build and query times
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import time
+
+from benchmarks.fake_eve import Store
+from epmanage.lib.agent import Agent
+from epmanage.lib.search import SearchIndex
+from epmanage.scripts.commands.agent import agent_keys
+
+QUERIES = ('host-0123', 'linux centos7 1999', 'hots-001234', 'te', 'team-3 debian', 'windows', 'nomatch')
+
+
+def scan(agents: list, query: str) -> list:
+    """Substring test of every agent, what a search without index costs"""
+    terms = query.lower().split()
+    return [x for x in agents if all(any(t in str(k).lower() for k in agent_keys(x) if k) for t in terms)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--agents', type=int, default=20000)
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    agents = [Agent(x) for x in Store(args.agents, 0, 0, 0, packages=0).collections['agent']]
+    start = time.perf_counter()
+    index = SearchIndex(agent_keys)
+    index.extend(agents)
+    print('index {:,} agents: {:.3f}s'.format(len(agents), time.perf_counter() - start))
+
+    print('{:<20} {:>8} {:>10} {:>10}'.format('query', 'matches', 'index ms', 'scan ms'))
+    for text in QUERIES:
+        start = time.perf_counter()
+        matches = index.search(text)
+        indexed = time.perf_counter() - start
+        start = time.perf_counter()
+        scan(agents, text)
+        scanned = time.perf_counter() - start
+        print('{:<20} {:>8} {:>10.2f} {:>10.2f}'.format(text, len(matches), indexed * 1000, scanned * 1000))
@@ -0,0 +1,397 @@
+"""
+fake_eve.py : Local stand-in for an EPManage/Eve server
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Implements the subset of the API used by the client:
+* /schema, /frontend/login, /frontend/packages and the package files (Range, If-Range)
+* agent, user and app collections: pagination, filter, where, projection, ETag / If-None-Match
+* items: GET, PATCH and DELETE with If-Match
+* /admin/apps
+* /_counters: number of requests per endpoint since the last call
+"""
+import argparse
+import base64
+import email.utils
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+SCHEMA = {
+    'agent': {
+        'uuid': {'type': 'string', 'readonly': True},
+        'hostname': {'type': 'string'},
+        'os': {'type': 'string', 'readonly': True},
+        'osversion': {'type': 'string', 'readonly': True},
+        'tags': {'type': 'list'},
+        'inventory': {'type': 'dict', 'readonly': True},
+        'enabled': {'type': 'boolean'},
+        'priority': {'type': 'integer'},
+    },
+    'user': {
+        'email': {'type': 'string'},
+        'firstname': {'type': 'string'},
+        'lastname': {'type': 'string'},
+        'roles': {'type': 'list'},
+    },
+    'app': {
+        'name': {'type': 'string', 'readonly': True},
+        'description': {'type': 'string'},
+        'version': {'type': 'string'},
+    },
+}
+
+OSES = [
+    ('windows', ['7', '10', '2012']),
+    ('linux', ['debian8', 'centos7']),
+    ('macos', ['10.12']),
+]
+
+ARCHS = ['x86', 'x64']
+
+META_FIELDS = frozenset(('_id', '_etag', '_updated', '_created', '_links'))
+
+
+def http_date(date: datetime) -> str:
+    return email.utils.format_datetime(date, usegmt=True)
+
+
+def make_token(privileges=('ro', 'rw', 'admin', 'superadmin'), lifetime: int = 86400) -> str:
+    """Unsigned token accepted by the client (it does not verify signatures)"""
+    def encode(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b'=').decode()
+
+    now = int(time.time())
+    return '{}.{}.{}'.format(
+        encode(dict(alg='RS512', typ='JWT')),
+        encode(dict(sub='benchmark', iat=now, nbf=now, exp=now + lifetime,
+                    aud=['urn:cmi_{}'.format(x) for x in privileges])),
+        encode(dict()))
+
+
+def matches(doc: dict, where: dict) -> bool:
+    """Evaluate the subset of MongoDB queries the client sends"""
+    for key, condition in where.items():
+        value = doc.get(key)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for operator, argument in condition.items():
+            if key in ('_updated', '_created') and operator in ('$gt', '$gte', '$lt', '$lte'):
+                value, argument = email.utils.parsedate_to_datetime(value), \
+                    email.utils.parsedate_to_datetime(argument)
+            if operator == '$gt' and not value > argument:
+                return False
+            elif operator == '$gte' and not value >= argument:
+                return False
+            elif operator == '$lt' and not value < argument:
+                return False
+            elif operator == '$lte' and not value <= argument:
+                return False
+            elif operator == '$ne' and value == argument:
+                return False
+            elif operator == '$in' and value not in argument:
+                return False
+    return True
+
+
+class Store(object):
+    """In-memory collections, generated deterministically"""
+
+    def __init__(self, agents: int, users: int, apps: int, inventory_size: int, packages: int = 2,
+                 package_size: int = 256 * 1024):
+        self.lock = threading.Lock()
+        self.collections = dict(agent=[], user=[], app=[])
+        rnd = random.Random(42)
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        for i in range(agents):
+            os_name, versions = OSES[i % len(OSES)]
+            self.add('agent', dict(
+                uuid=str(uuid.UUID(int=rnd.getrandbits(128))),
+                hostname='host-{:06d}'.format(i),
+                os=os_name,
+                osversion=versions[i % len(versions)],
+                tags=[dict(name='system-{}'.format(os_name), type='system'),
+                      dict(name='team-{}'.format(i % 7), type='user')],
+                inventory=dict(software=['software-{}'.format(j) for j in range(inventory_size)]),
+                enabled=True,
+                priority=i % 5), now - timedelta(days=i % 90))
+        for i in range(users):
+            self.add('user', dict(
+                email='user{}@example.com'.format(i),
+                firstname='First{}'.format(i),
+                lastname='Last{}'.format(i),
+                roles=['ro']), now)
+        for i in range(apps):
+            self.add('app', dict(
+                name='app{}'.format(i),
+                description='Application {}'.format(i),
+                version='1.0'), now)
+        self.schema_date = now
+
+        # `packages` builds per (os, osversion, arch), all sharing the same content
+        self.packages = []
+        self.files = dict()
+        content = rnd.getrandbits(package_size * 8).to_bytes(package_size, 'little') if packages else b''
+        for os_name, versions in OSES:
+            builds = []
+            for osversion in versions:
+                for arch in ARCHS:
+                    for build in range(packages):
+                        name = 'agent-{}-{}-{}-{}.pkg'.format(os_name, osversion, arch, build)
+                        builds.append(dict(osversion=osversion, arch=arch, name=name,
+                                           url='/packages/{}'.format(name)))
+                        self.files[name] = content
+            self.packages.append(dict(os=os_name, date=now.isoformat(), packages=builds))
+
+    def add(self, model: str, doc: dict, updated: datetime):
+        doc['_id'] = uuid.uuid4().hex[:24]
+        doc['_created'] = http_date(updated)
+        self.touch(model, doc, updated)
+        self.collections[model].append(doc)
+
+    @staticmethod
+    def touch(model: str, doc: dict, updated: datetime):
+        doc['_updated'] = http_date(updated)
+        doc.pop('_etag', None)
+        doc['_etag'] = hashlib.sha1(json.dumps(doc, sort_keys=True).encode()).hexdigest()
+        doc['_links'] = dict(self=dict(title=model, href='{}/{}'.format(model, doc['_id'])))
+
+    def find(self, model: str, key: str):
+        for doc in self.collections[model]:
+            if key in (doc['_id'], doc.get('uuid'), doc.get('email'), doc.get('name')):
+                return doc
+        return None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately: without this, delayed ACKs add 40ms per keep-alive request
+    disable_nagle_algorithm = True
+    store = None  # type: Store
+    latency = 0.0
+    counters = None  # type: Counter
+
+    def log_message(self, *args):
+        pass
+
+    def count(self):
+        path = re.sub(r'/[0-9a-f]{24}$', '/{id}', urlsplit(self.path).path)
+        with self.store.lock:
+            self.counters['{} {}'.format(self.command, path)] += 1
+
+    def send_json(self, status: int, body=None, headers: dict = None):
+        if self.latency:
+            time.sleep(self.latency)
+        data = b''
+        if body is not None:
+            data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        headers = dict(headers or {})
+        if body is not None:
+            headers.setdefault('Content-Type', 'application/json')
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_cached(self, body: bytes, headers: dict = None):
+        """Send a body with its ETag, or 304 if the client has it"""
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            return self.send_json(304, headers=dict(ETag=etag))
+        return self.send_json(200, body, dict(headers or {}, ETag=etag))
+
+    def error(self, code: int, message: str):
+        self.send_json(code, dict(_status='ERR', _error=dict(code=code, message=message)))
+
+    def read_body(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        self.count()
+        url = urlsplit(self.path)
+        query = {key: value[-1] for key, value in parse_qs(url.query).items()}
+        parts = [x for x in url.path.split('/') if x]
+
+        if parts == ['_counters']:
+            with self.store.lock:
+                counters = dict(self.counters)
+                self.counters.clear()
+            counters.pop('GET /_counters', None)
+            return self.send_json(200, counters)
+        elif parts == ['schema']:
+            return self.send_cached(json.dumps(SCHEMA).encode(), {'Last-Modified': http_date(self.store.schema_date)})
+        elif parts == ['frontend', 'packages']:
+            return self.send_cached(json.dumps(dict(data=self.store.packages)).encode())
+        elif len(parts) == 2 and parts[0] == 'packages':
+            return self.send_package(parts[1])
+        elif parts == ['admin', 'apps']:
+            return self.send_json(200, dict(apps=[x['name'] for x in self.store.collections['app']]))
+
+        if not parts or parts[0] not in self.store.collections or len(parts) > 2:
+            return self.error(404, 'Not found')
+
+        model = parts[0]
+        if len(parts) == 2:
+            doc = self.store.find(model, parts[1])
+            if not doc:
+                return self.error(404, 'Not found')
+            etag = '"{}"'.format(doc['_etag'])
+            if self.headers.get('If-None-Match') == etag:
+                return self.send_json(304, headers=dict(ETag=etag))
+            return self.send_json(200, doc, dict(ETag=etag))
+
+        docs = self.store.collections[model]
+        if 'filter' in query:
+            key, _, value = query['filter'].partition('=')
+            docs = [x for x in docs if str(x.get(key)) == value]
+        if 'where' in query:
+            where = json.loads(query['where'])
+            docs = [x for x in docs if matches(x, where)]
+        page = int(query.get('page', 1))
+        max_results = int(query.get('max_results', 25))
+        items = docs[(page - 1) * max_results:page * max_results]
+        if 'projection' in query:
+            keep = {key for key, value in json.loads(query['projection']).items() if value} | META_FIELDS
+            items = [{key: value for key, value in x.items() if key in keep} for x in items]
+        links = dict(self=dict(title=model, href=model))
+        if page * max_results < len(docs):
+            links['next'] = dict(title='next page', href='{}?page={}'.format(model, page + 1))
+        return self.send_cached(json.dumps(dict(
+            _items=items,
+            _links=links,
+            _meta=dict(page=page, max_results=max_results, total=len(docs)))).encode())
+
+    def send_package(self, name: str):
+        content = self.store.files.get(name)
+        if content is None:
+            return self.error(404, 'Not found')
+        etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Disposition': 'attachment; filename={}'.format(name),
+            'Accept-Ranges': 'bytes',
+            'ETag': etag,
+        }
+        if self.headers.get('If-None-Match') == etag:
+            return self.send_json(304, headers=dict(ETag=etag))
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range', etag) == etag:
+            start = int(match.group(1))
+            if start >= len(content):
+                return self.send_json(416, b'', {'Content-Range': 'bytes */{}'.format(len(content))})
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, len(content) - 1, len(content))
+            return self.send_json(206, content[start:], headers)
+        return self.send_json(200, content, headers)
+
+    def item_for_write(self, parts: list):
+        """Item targeted by a PATCH or DELETE, None once the error is sent"""
+        if len(parts) != 2 or parts[0] not in self.store.collections:
+            return self.error(404, 'Not found')
+        doc = self.store.find(parts[0], parts[1])
+        if not doc:
+            return self.error(404, 'Not found')
+        if self.headers.get('If-Match') != doc['_etag']:
+            return self.error(412, 'Client and server etags don\'t match')
+        return doc
+
+    def do_PATCH(self):
+        self.count()
+        parts = [x for x in urlsplit(self.path).path.split('/') if x]
+        changes = self.read_body()
+        with self.store.lock:
+            doc = self.item_for_write(parts)
+            if doc is None:
+                return
+            doc.update(changes)
+            self.store.touch(parts[0], doc, datetime.now(timezone.utc).replace(microsecond=0))
+            return self.send_json(200, dict(
+                {key: doc[key] for key in META_FIELDS if key in doc}, _status='OK'))
+
+    def do_DELETE(self):
+        self.count()
+        parts = [x for x in urlsplit(self.path).path.split('/') if x]
+        with self.store.lock:
+            doc = self.item_for_write(parts)
+            if doc is None:
+                return
+            self.store.collections[parts[0]].remove(doc)
+            return self.send_json(204)
+
+    def do_POST(self):
+        self.count()
+        parts = [x for x in urlsplit(self.path).path.split('/') if x]
+        self.read_body()
+        if parts == ['frontend', 'login']:
+            return self.send_json(200, make_token().encode(), {'Content-Type': 'text/plain'})
+        elif len(parts) == 3 and parts[:2] == ['admin', 'apps']:
+            return self.send_json(204)
+        return self.error(404, 'Not found')
+
+
+def serve(port: int = 0, agents: int = 1000, users: int = 50, apps: int = 10, inventory_size: int = 20,
+          latency: float = 0.0, packages: int = 2, package_size: int = 256 * 1024) -> ThreadingHTTPServer:
+    """Create the server; call serve_forever() on the result to run it"""
+    handler = type('FakeEveHandler', (Handler,), dict(
+        store=Store(agents, users, apps, inventory_size, packages, package_size),
+        latency=latency,
+        counters=Counter()))
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve_background(**kwargs) -> ThreadingHTTPServer:
+    """Start the server in a daemon thread"""
+    server = serve(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def base_url(server: ThreadingHTTPServer) -> str:
+    return 'http://{}:{}'.format(*server.server_address)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in EPManage server')
+    parser.add_argument('--port', type=int, default=5000, help='Port to listen on (0: any free port)')
+    parser.add_argument('--agents', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--apps', type=int, default=10)
+    parser.add_argument('--inventory-size', type=int, default=20)
+    parser.add_argument('--packages', type=int, default=2, help='Builds per os, version and architecture')
+    parser.add_argument('--package-size', type=int, default=256 * 1024, help='Size of the package files')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    args = parser.parse_args()
+
+    srv = serve(args.port, args.agents, args.users, args.apps, args.inventory_size, args.latency, args.packages,
+                args.package_size)
+    print('Listening on {}'.format(base_url(srv)), flush=True)
+    srv.serve_forever()
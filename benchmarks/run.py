@@ -0,0 +1,327 @@
+"""
+run.py : Benchmark suite against the local stand-in server
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Every run of a scenario gets a fresh server process and a fresh client process,
+so that writes, caches and memory peaks do not leak from one run to the next.
+The client process prepares the scenario (untimed), then times it; the
+allocation peak is measured in a separate run since tracemalloc slows it down.
+
+    python -m benchmarks.run --agents 5000 --latency 0.005 --output results.json
+    python -m benchmarks.run --compare results.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from pathlib import Path
+from urllib.request import urlopen
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# Metrics compared with --compare, lower is better
+COMPARED = ('wall_s', 'peak_rss_kb', 'alloc_peak_kb')
+
+
+def max_rss_kb() -> int:
+    """Peak resident memory of the current process"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def server_requests(url: str) -> int:
+    """Requests received by the server since the previous call"""
+    with urlopen('{}/_counters'.format(url)) as response:
+        return sum(json.loads(response.read().decode()).values())
+
+
+# Scenarios: prepare what they need and return the timed function, which returns the number of operations
+
+def eve_list(config: dict):
+    from epmanage.lib.agent import AgentAPI
+    api = AgentAPI()
+    return lambda: sum(1 for _ in api.iter(max_results=config['page_size'], jobs=config['jobs']))
+
+
+def eve_list_stream(config: dict):
+    from epmanage.lib.agent import AgentAPI
+    api = AgentAPI()
+    return lambda: sum(1 for _ in api.iter(max_results=config['page_size'], stream=True))
+
+
+def eve_get(config: dict):
+    from epmanage.lib.agent import AgentAPI
+    api = AgentAPI()
+    ids = [x.id for x in api.iter(max_results=config['page_size'], projection=['uuid'])][:config['items']]
+
+    def run():
+        for value in ids:
+            item, error = api.get(value)
+            if error:
+                raise RuntimeError(error)
+        return len(ids)
+    return run
+
+
+def eve_patch(config: dict):
+    from epmanage.lib.agent import AgentAPI
+    api = AgentAPI()
+    items = list(api.iter(max_results=config['page_size']))[:config['items']]
+    return lambda: sum(1 for _, error in api.patch_many(items, dict(priority=9), jobs=config['jobs']) if not error)
+
+
+def eve_delete(config: dict):
+    from epmanage.lib.agent import AgentAPI
+    api = AgentAPI()
+    items = list(api.iter(max_results=config['page_size']))[:config['items']]
+    return lambda: sum(1 for _, error in api.delete_many(items, jobs=config['jobs']) if not error)
+
+
+def package_download(config: dict):
+    from epmanage.lib.package import PackageAPI
+    api = PackageAPI()
+    targets = [(x['os'], pkg['osversion'], pkg['arch']) for x in api.list() for pkg in x['packages']]
+    targets = list(OrderedDict.fromkeys(targets))
+
+    def run():
+        for os_name, osversion, arch in targets:
+            api.download(os_name, osversion, arch, lambda pkgs: 0, Path(config['tmp']))
+        return len(targets)
+    return run
+
+
+def cli_command(*args: str, answer: str = ''):
+    """End-to-end scenario: a command line, imports included"""
+    def scenario(config: dict):
+        token = Path(config['tmp']) / 'token'
+        token.write_text(config['token'])
+        argv = ['--tokenfile', str(token), '--baseurl', config['url'], '--cache-dir', config['tmp']]
+        argv.extend(x.format(**config) for x in args)
+
+        def run():
+            from epmanage.scripts.utils.runner import Capture, run_command
+            stderr = Capture()
+            status = run_command(argv, stdout=Capture(), stderr=stderr, stdin=io.StringIO(answer))
+            if status:
+                raise RuntimeError('{} exited with {}: {}'.format(' '.join(args), status, stderr.getvalue()))
+            return 1
+        return run
+    return scenario
+
+
+SCENARIOS = OrderedDict([
+    ('eve.list', eve_list),
+    ('eve.list.stream', eve_list_stream),
+    ('eve.get', eve_get),
+    ('eve.patch', eve_patch),
+    ('eve.delete', eve_delete),
+    ('package.download', package_download),
+    ('cli.agent-list', cli_command('agent', 'list', '--format', 'json')),
+    ('cli.agent-find', cli_command('agent', 'find', 'host-0012')),
+    ('cli.agent-set', cli_command('agent', 'set', '--where', '{{"os": "linux"}}', 'priority', '3')),
+    ('cli.package-list', cli_command('package', 'list')),
+    ('cli.package-download', cli_command('package', 'download', 'windows', '--osversion', 'latest', '--arch', 'x64',
+                                         '--directory', '{tmp}', answer='0\n')),
+])
+
+
+def child(name: str, url: str, config: dict, trace: bool) -> dict:
+    """Run one scenario in the current process (the client side of a run)"""
+    with tempfile.TemporaryDirectory(prefix='epmanage-bench-') as tmp:
+        config = dict(config, url=url, tmp=tmp)
+        if not name.startswith('cli.'):
+            from epmanage.lib.api import req_sess
+            from epmanage.lib.cache import resource_cache
+            req_sess.base_url = url
+            resource_cache.path = Path(tmp)
+
+        func = SCENARIOS[name](config)
+        server_requests(url)
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        operations = func()
+        wall = time.perf_counter() - start
+        result = dict(wall_s=wall, operations=operations, requests=server_requests(url), peak_rss_kb=max_rss_kb())
+        if trace:
+            result['alloc_peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        return result
+
+
+class Server(object):
+    """Stand-in server in a subprocess, on a free port"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks.fake_eve', '--port', '0',
+             '--agents', str(args.agents), '--users', str(args.users), '--apps', str(args.apps),
+             '--inventory-size', str(args.inventory_size), '--packages', str(args.packages),
+             '--package-size', str(args.package_size), '--latency', str(args.latency)],
+            cwd=str(ROOT), stdout=subprocess.PIPE, universal_newlines=True)
+        line = self.process.stdout.readline()
+        if not line.startswith('Listening on '):
+            self.close()
+            raise RuntimeError('The server did not start')
+        self.url = line.split()[-1]
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def run_once(name: str, args: argparse.Namespace, config: dict, trace: bool = False) -> dict:
+    env = {key: value for key, value in os.environ.items() if not key.startswith('EPMANAGE-')}
+    env['EPMANAGE-DAEMON'] = '0'
+    with Server(args) as server:
+        proc = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.run', '--child', name, '--url', server.url,
+             '--config', json.dumps(config)] + (['--trace'] if trace else []),
+            cwd=str(ROOT), env=env, stdout=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode:
+        raise RuntimeError('Scenario {} failed'.format(name))
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def run_scenario(name: str, args: argparse.Namespace, config: dict) -> dict:
+    runs = [run_once(name, args, config) for _ in range(args.repeat)]
+    walls = [x['wall_s'] for x in runs]
+    wall = statistics.median(walls)
+    requests = runs[-1]['requests']
+    return dict(
+        wall_s=round(wall, 6),
+        wall_min_s=round(min(walls), 6),
+        operations=runs[-1]['operations'],
+        ops_per_s=round(runs[-1]['operations'] / wall, 1),
+        requests=requests,
+        req_per_s=round(requests / wall, 1),
+        peak_rss_kb=max(x['peak_rss_kb'] for x in runs),
+        alloc_peak_kb=run_once(name, args, config, trace=True)['alloc_peak_kb'])
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Print the changes against a baseline, return the regressions"""
+    regressions = []
+    print('\n{:<24} {:<14} {:>12} {:>12} {:>8}'.format('scenario', 'metric', 'baseline', 'current', 'change'))
+    for name, result in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            continue
+        for metric in COMPARED:
+            old, new = previous.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions.append((name, metric, change))
+            print('{:<24} {:<14} {:>12} {:>12} {:>+7.1%}{}'.format(name, metric, old, new, change, flag))
+    return regressions
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(ROOT),
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main(args: argparse.Namespace):
+    from benchmarks.fake_eve import make_token
+
+    config = dict(page_size=args.page_size, jobs=args.jobs, items=args.items, token=make_token())
+    server = dict(agents=args.agents, users=args.users, apps=args.apps, inventory_size=args.inventory_size,
+                  packages=args.packages, package_size=args.package_size, latency=args.latency)
+    results = OrderedDict()
+    print('{:<24} {:>9} {:>9} {:>9} {:>10} {:>11} {:>12}'.format(
+        'scenario', 'wall s', 'requests', 'req/s', 'ops/s', 'peak RSS kB', 'alloc peak kB'))
+    for name in args.scenarios or SCENARIOS:
+        result = results[name] = run_scenario(name, args, config)
+        print('{:<24} {:>9.3f} {:>9} {:>9.1f} {:>10.1f} {:>11,} {:>12,}'.format(
+            name, result['wall_s'], result['requests'], result['req_per_s'], result['ops_per_s'],
+            result['peak_rss_kb'], result['alloc_peak_kb']), flush=True)
+
+    config.pop('token')
+    report = dict(
+        date=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        revision=git_revision(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        repeat=args.repeat,
+        config=dict(config, **server),
+        results=results)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2) + '\n')
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if baseline.get('config') != report['config']:
+            print('\nWarning: the baseline was measured with another configuration', file=sys.stderr)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help='Scenarios to run (default: all): {}'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--agents', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--apps', type=int, default=20)
+    parser.add_argument('--inventory-size', type=int, default=20)
+    parser.add_argument('--packages', type=int, default=2, help='Builds per os, version and architecture')
+    parser.add_argument('--package-size', type=int, default=1024 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--jobs', type=int, default=4, help='Concurrency of the library calls')
+    parser.add_argument('--items', type=int, default=500, help='Items read, patched or deleted one by one')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per scenario (the median is kept)')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of a previous run; exit with 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative increase reported as a regression')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    parser.add_argument('--trace', action='store_true', help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.child:
+        print(json.dumps(child(arguments.child, arguments.url, json.loads(arguments.config), arguments.trace)))
+    else:
+        unknown = set(arguments.scenarios) - set(SCENARIOS)
+        if unknown:
+            parser.error('Unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+        main(arguments)
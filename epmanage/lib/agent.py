@@ -23,6 +23,8 @@ from epmanage.lib.eve_api import EveAPI, EveItem
 
 
 class Agent(EveItem):
+    __slots__ = ()
+
     def __init__(self, data):
         super(Agent, self).__init__(data)
 
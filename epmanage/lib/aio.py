@@ -0,0 +1,307 @@
+"""
+aio.py : asyncio EPManage APIs
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Requires the optional aiohttp dependency (pip install epmanage-cli[async])
+"""
+import asyncio
+from collections import deque
+from typing import AsyncIterator, Optional
+
+import aiohttp
+
+from epmanage.lib.agent import Agent
+from epmanage.lib.api import EPCAuth, CommException, DEFAULT_TRANSPORT, req_sess
+from epmanage.lib.app import App
+from epmanage.lib.codec import codec
+from epmanage.lib.eve_api import EveAPI, EveItem
+from epmanage.lib.package import PackageAPI
+from epmanage.lib.schema import schema_registry
+from epmanage.lib.user import User
+
+# Seconds a whole request may take, as aiohttp does by default
+DEFAULT_TIMEOUT = 300
+
+
+class AsyncResponse(object):
+    """Fully read response, exposing the subset of requests.Response we use"""
+
+    def __init__(self, status_code: int, headers, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return codec.decode(self)
+
+
+class _HeaderHolder(object):
+    """Lets requests authentication classes decorate aiohttp headers"""
+
+    def __init__(self, headers: dict):
+        self.headers = headers
+
+
+class AsyncEPSession(object):
+    """
+    asyncio counterpart of EPSession.
+    `limit` bounds the number of simultaneous connections of the session.
+    Connections and reads are limited as with the synchronous transport,
+    `timeout` bounds a whole request (aiohttp's 300s by default)
+    """
+
+    def __init__(self, base_url: str = '', auth: Optional[EPCAuth] = None, limit: int = 100,
+                 timeout: Optional[float] = None, connect_timeout: float = DEFAULT_TRANSPORT.connect_timeout,
+                 read_timeout: float = DEFAULT_TRANSPORT.read_timeout):
+        self.base_url = base_url
+        self.auth = auth
+        self.limit = limit
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._session = None  # type: Optional[aiohttp.ClientSession]
+
+    @classmethod
+    def from_session(cls, session=req_sess, **kwargs) -> 'AsyncEPSession':
+        """Reuse the base_url, authentication and timeouts of a synchronous session"""
+        transport = session.transport or DEFAULT_TRANSPORT
+        kwargs.setdefault('connect_timeout', transport.connect_timeout)
+        kwargs.setdefault('read_timeout', transport.read_timeout)
+        return cls(session.base_url, session.auth, **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if not self._session:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                timeout=aiohttp.ClientTimeout(total=self.timeout, sock_connect=self.connect_timeout,
+                                              sock_read=self.read_timeout))
+        return self._session
+
+    async def request(self, method: str, url: str, headers: Optional[dict] = None, **kwargs) -> AsyncResponse:
+        """
+        Send a request and read its whole body:
+        * Refuse any communication if base_url is not set
+        * Get the appropriate URL
+        * Raise CommException on connection errors and timeouts, as the synchronous session does
+        """
+        if not self.base_url:
+            raise CommException("No base_url...refusing communication")
+        if not url.startswith('http'):
+            url = self.base_url + url
+
+        headers = dict(headers or {})
+        if self.auth:
+            self.auth(_HeaderHolder(headers))
+        try:
+            async with self._get_session().request(method, url, headers=headers, **kwargs) as rsp:
+                return AsyncResponse(rsp.status, rsp.headers, await rsp.read())
+        except aiohttp.ClientError as exc:
+            raise CommException('{} {} failed: {}'.format(method, url, exc))
+        except asyncio.TimeoutError:
+            raise CommException('{} {} timed out'.format(method, url))
+
+    async def get(self, url: str, **kwargs) -> AsyncResponse:
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> AsyncResponse:
+        return await self.request('POST', url, **kwargs)
+
+    async def patch(self, url: str, **kwargs) -> AsyncResponse:
+        return await self.request('PATCH', url, **kwargs)
+
+    async def delete(self, url: str, **kwargs) -> AsyncResponse:
+        return await self.request('DELETE', url, **kwargs)
+
+
+class AsyncEveAPI(object):
+    """
+    asyncio counterpart of EveAPI.
+    Items are the same classes as the synchronous API; call load_schema()
+    once before using their schema dependent methods (attributes...)
+    """
+
+    def __init__(self, session: AsyncEPSession, model, item_cls):
+        self._sess = session
+        self._model = model
+        self._item_cls = item_cls
+        item_cls._model = model
+
+    async def load_schema(self) -> dict:
+        req = await self._sess.get('/schema')
+        if req.status_code != 200:
+            raise CommException('Cannot fetch schema')
+        schema = req.json()
+        schema_registry.set(schema)
+        return schema.get(self._model) or dict()
+
+    async def _get_page(self, params: dict, page: int) -> Optional[dict]:
+        req = await self._sess.get(
+            '/{}'.format(self._model),
+            params=dict(params, page=page),
+            headers=codec.accept())
+        if req.status_code != 200:
+            return None
+        return req.json()
+
+    async def iter(self, filter=None, max_results: Optional[int] = None,
+                   jobs: int = 1) -> AsyncIterator[EveItem]:
+        """Iterate over every item of the collection, see EveAPI.iter"""
+        params = dict()
+        if filter:
+            params['filter'] = filter
+        if max_results:
+            params['max_results'] = max_results
+
+        page = 1
+        last = None
+        pending = deque([(page, asyncio.ensure_future(self._get_page(params, page)))])
+        try:
+            while pending:
+                current, future = pending.popleft()
+                data = await future
+                if data is None:
+                    if current == 1:
+                        return
+                    raise CommException('Cannot fetch page {} of {}'.format(current, self._model))
+
+                if last is None or 'next' not in data.get('_links', {}):
+                    last = EveAPI.last_page(data, current)
+
+                if last is None:
+                    if page == current and 'next' in data.get('_links', {}):
+                        page += 1
+                        pending.append((page, asyncio.ensure_future(self._get_page(params, page))))
+                else:
+                    while page < last and len(pending) < jobs:
+                        page += 1
+                        pending.append((page, asyncio.ensure_future(self._get_page(params, page))))
+
+                for item in data.get('_items', []):
+                    yield self._item_cls(item)
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    async def list(self, filter=None) -> list:
+        return [item async for item in self.iter(filter)]
+
+    async def get(self, info):
+        req = await self._sess.get('/{}/{}'.format(self._model, info), headers=codec.accept())
+        if req.status_code != 200:
+            return None, req.json()
+        return self._item_cls(req.json()), None
+
+    async def get2(self, attr, value):
+        items = await self.list('{}={}'.format(attr, value))
+        if len(items) == 1:
+            return items[0]
+
+    async def patch(self, item: EveItem, params: dict):
+        req = await self._sess.patch(
+            '/{}'.format(item.get_url()),
+            json=params,
+            headers=dict(codec.accept(), **{
+                'If-Match': item.etag
+            }))
+        if req.status_code == 200:
+            item.update(req.json())
+            return True, None
+        else:
+            return False, req.json()
+
+    async def delete(self, item: EveItem):
+        req = await self._sess.delete(
+            '/{}'.format(item.get_url()),
+            headers=dict(codec.accept(), **{
+                'If-Match': item.etag
+            }))
+        if req.status_code == 204:
+            return True, None
+        else:
+            return False, req.json()
+
+
+class AsyncAgentAPI(AsyncEveAPI):
+    def __init__(self, session: AsyncEPSession):
+        super(AsyncAgentAPI, self).__init__(session, 'agent', Agent)
+
+
+class AsyncUserAPI(AsyncEveAPI):
+    def __init__(self, session: AsyncEPSession):
+        super(AsyncUserAPI, self).__init__(session, 'user', User)
+
+    async def from_email(self, email: str) -> User:
+        return await self.get2('email', email)
+
+
+class AsyncAppAPI(AsyncEveAPI):
+    def __init__(self, session: AsyncEPSession):
+        super(AsyncAppAPI, self).__init__(session, 'app', App)
+
+    async def from_name(self, name: str) -> App:
+        return await self.get2('name', name)
+
+    async def admin_list(self) -> list:
+        req = await self._sess.get('/admin/apps')
+        if req.status_code != 200:
+            return []
+        else:
+            return req.json().get('apps', [])
+
+    async def manage(self, name, action):
+        req = await self._sess.post(
+            '/admin/apps/{}'.format(name),
+            json=dict(action=action))
+        if req.status_code not in [201, 204]:
+            return False, req.json()
+        else:
+            return True, None
+
+
+class AsyncPackageAPI(object):
+    def __init__(self, session: AsyncEPSession):
+        self._sess = session
+
+    async def list(self) -> list:
+        req = await self._sess.get('/frontend/packages')
+        if req.status_code != 200:
+            return []
+
+        items = req.json().get('data')
+        return items
+
+    async def download(self, os: str, osversion: Optional[str], arch: Optional[str], choose_callback=None):
+        pkg = PackageAPI.select(await self.list(), os, osversion, arch, choose_callback)
+
+        req = await self._sess.get('{}'.format(pkg['url']))
+        if req.status_code != 200:
+            raise ValueError('Cannot download package')
+
+        return PackageAPI.filename(req.headers), req.content
@@ -18,10 +18,25 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
+import random
+import threading
+from collections import namedtuple
+from typing import Optional
+
+import requests.adapters
 import requests.auth
+from urllib3.util.retry import Retry
 
 from epmanage import __version__
 
+# Status codes worth retrying: the request was not processed, or the server asks to come back later
+RETRY_STATUS = frozenset((429, 502, 503, 504))
+
+Transport = namedtuple('Transport', ('connect_timeout', 'read_timeout', 'retries', 'backoff', 'backoff_max',
+                                     'pool_size', 'keep_alive'))
+DEFAULT_TRANSPORT = Transport(connect_timeout=5.0, read_timeout=60.0, retries=3, backoff=0.5, backoff_max=30.0,
+                              pool_size=16, keep_alive=True)
+
 
 class EPCAuth(requests.auth.AuthBase):
     """Custom authentication class. Currently uses JWT"""
@@ -37,12 +52,135 @@ class EPCAuth(requests.auth.AuthBase):
         return r
 
 
+class TransportStats(object):
+    """Thread-safe counters of the transport"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.retries = 0
+        # Counters of the connection pools which were closed
+        self.requests = 0
+        self.connections = 0
+
+    def retried(self):
+        with self._lock:
+            self.retries += 1
+
+
+class EPRetry(Retry):
+    """
+    Retry policy of the session:
+    * exponential backoff with full jitter, so parallel clients do not retry in lockstep
+    * every retry is counted in the session stats
+    Retry-After is honoured by urllib3 for 429 and 503 responses, up to max_backoff seconds.
+    Only connection errors are retried for non idempotent methods (the request never reached the server)
+    """
+
+    def __init__(self, *args, stats: Optional[TransportStats] = None, max_backoff: float = 30.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = stats
+        self.max_backoff = max_backoff
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.stats = self.stats
+        retry.max_backoff = self.max_backoff
+        return retry
+
+    def get_backoff_time(self) -> float:
+        # urllib3 computes backoff_factor * 2 ** (retries - 1), or 0 for the first retry
+        consecutive = len([x for x in self.history if x.redirect_location is None])
+        if consecutive <= 0:
+            return 0
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** (consecutive - 1)))
+
+    def get_retry_after(self, response) -> Optional[float]:
+        # A slow server must not block the caller for the hour its Retry-After may ask for
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.max_backoff)
+
+    def increment(self, *args, **kwargs):
+        retry = super().increment(*args, **kwargs)
+        if self.stats:
+            self.stats.retried()
+        return retry
+
+
 class EPSession(requests.Session):
     """Custom session to provide dynamic routing"""
 
     def __init__(self):
         super().__init__()
         self.base_url = ''
+        self.stats = TransportStats()
+        self.transport = None  # type: Optional[Transport]
+        self.metrics = None  # Set by Metrics.attach
+        self.configure()
+
+    def configure(self, **kwargs):
+        """
+        Setup timeouts, connection pooling and retries.
+        Arguments are fields of Transport, missing ones keep their current value
+        """
+        transport = (self.transport or DEFAULT_TRANSPORT)._replace(**kwargs)
+        if transport == self.transport:
+            # Keep the open connections
+            return
+        self.transport = transport
+        retry = EPRetry(
+            total=self.transport.retries,
+            connect=self.transport.retries,
+            read=self.transport.retries,
+            status=self.transport.retries,
+            status_forcelist=RETRY_STATUS,
+            backoff_factor=self.transport.backoff,
+            respect_retry_after_header=True,
+            # Give the last response back to the caller instead of raising
+            raise_on_status=False,
+            stats=self.stats,
+            max_backoff=self.transport.backoff_max)
+        for adapter in set(self.adapters.values()):
+            requests_sent, connections = self._pool_counters(adapter)
+            self.stats.requests += requests_sent
+            self.stats.connections += connections
+            adapter.close()
+        for prefix in ('https://', 'http://'):
+            self.mount(prefix, requests.adapters.HTTPAdapter(
+                pool_connections=self.transport.pool_size,
+                pool_maxsize=self.transport.pool_size,
+                max_retries=retry))
+        if self.transport.keep_alive:
+            self.headers['Connection'] = 'keep-alive'
+        else:
+            self.headers['Connection'] = 'close'
+
+    @staticmethod
+    def _pool_counters(adapter) -> tuple:
+        """Number of requests sent and connections opened by the pools of an adapter"""
+        requests_sent = connections = 0
+        if isinstance(adapter, requests.adapters.HTTPAdapter):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    requests_sent += pool.num_requests
+                    connections += pool.num_connections
+        return requests_sent, connections
+
+    def transport_stats(self) -> dict:
+        """Counters of the transport: requests sent, connections opened and reused, retries"""
+        requests_sent, connections = self.stats.requests, self.stats.connections
+        for adapter in set(self.adapters.values()):
+            counters = self._pool_counters(adapter)
+            requests_sent += counters[0]
+            connections += counters[1]
+        return dict(
+            requests=requests_sent,
+            connections=connections,
+            reused=max(0, requests_sent - connections),
+            retries=self.stats.retries)
 
     def prepare_request(self, request):
         """
@@ -72,27 +210,36 @@ class EPSession(requests.Session):
         """
         Prepare the request before sending it:
         * Refuse any communication if base_url is not set
+        * Use the transport timeouts unless another one is given
+        * Count the requests without response in the metrics, if any
         """
         if not self.base_url:
             raise CommException("No base_url...refusing communication")
-
-        return super(EPSession, self).request(
-            method,
-            url,
-            params,
-            data,
-            headers,
-            cookies,
-            files,
-            auth,
-            timeout,
-            allow_redirects,
-            proxies,
-            hooks,
-            stream,
-            verify,
-            cert,
-            json)
+        if timeout is None:
+            timeout = (self.transport.connect_timeout, self.transport.read_timeout)
+
+        try:
+            return super(EPSession, self).request(
+                method,
+                url,
+                params,
+                data,
+                headers,
+                cookies,
+                files,
+                auth,
+                timeout,
+                allow_redirects,
+                proxies,
+                hooks,
+                stream,
+                verify,
+                cert,
+                json)
+        except CommException:
+            if self.metrics is not None:
+                self.metrics.error(method, url)
+            raise
 
 req_sess = EPSession()
 CommException = requests.exceptions.RequestException
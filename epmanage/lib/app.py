@@ -21,10 +21,13 @@ along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 from typing import List
 
 from epmanage.lib.api import req_sess
+from epmanage.lib.codec import codec
 from epmanage.lib.eve_api import EveAPI, EveItem
 
 
 class App(EveItem):
+    __slots__ = ()
+
     def __init__(self, data):
         super(App, self).__init__(data)
 
@@ -41,13 +44,13 @@ class AppAPI(EveAPI):
         if req.status_code != 200:
             return []
         else:
-            return req.json().get('apps', [])
+            return codec.decode(req).get('apps', [])
 
     def manage(self, name, action):
         req = req_sess.post(
             '/admin/apps/{}'.format(name),
             json=dict(action=action))
         if req.status_code not in [201, 204]:
-            return False, req.json()
+            return False, codec.decode(req)
         else:
             return True, None
@@ -23,6 +23,7 @@ from typing import Optional, Tuple
 import jwt
 
 from epmanage.lib.api import req_sess
+from epmanage.lib.codec import codec
 
 __token = None
 
@@ -33,7 +34,7 @@ def auth(email: str, password: str) -> Tuple[bool, str]:
         '/frontend/login',
         json=dict(email=email, password=password))
     if req.status_code != 200:
-        return False, req.json().get('_error', dict()).get('message', 'Unknown error')
+        return False, codec.decode(req).get('_error', dict()).get('message', 'Unknown error')
     else:
         __token = req.text
         return True, req.text
@@ -75,7 +76,7 @@ def login_mfa(mfa_token: str, raw_token: Optional[str] = None) -> Tuple[bool, st
                         headers={'Authorization': 'Bearer {}'.format(__token)},
                         json=dict(code=mfa_token))
     if req.status_code != 200:
-        return False, req.json().get('_error', dict()).get('message', 'Unknown error')
+        return False, codec.decode(req).get('_error', dict()).get('message', 'Unknown error')
     else:
         __token = req.text
         return True, req.text
@@ -0,0 +1,117 @@
+"""
+cache.py : On-disk cache for API resources
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from epmanage.lib.api import req_sess
+from epmanage.lib.codec import codec
+
+
+def default_cache_dir() -> Path:
+    base = os.environ.get('XDG_CACHE_HOME')
+    if base:
+        return Path(base) / 'epmanage'
+    return Path.home() / '.cache' / 'epmanage'
+
+
+class ResourceCache(object):
+    """
+    Cache JSON resources on disk, keyed by their full URL.
+    Entries younger than the TTL are used as is, older ones are revalidated
+    with If-None-Match / If-Modified-Since
+    """
+
+    def __init__(self, path: Optional[Path] = None, ttl: int = 3600):
+        self.path = path or default_cache_dir()
+        self.ttl = ttl
+        self.offline = False  # Never revalidate, use whatever is cached
+
+    def _entry_path(self, url: str) -> Path:
+        return Path(self.path) / '{}.json'.format(hashlib.sha1(url.encode()).hexdigest())
+
+    def _load(self, url: str) -> Optional[dict]:
+        try:
+            entry = codec.loads(self._entry_path(url).read_bytes())
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def _store(self, url: str, entry: dict):
+        path = self._entry_path(url)
+        # One temporary file per thread: batch lines and daemon commands store concurrently
+        tmp = path.with_suffix('.tmp{}-{}'.format(os.getpid(), threading.get_ident()))
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_text(codec.dumps(entry))
+            os.replace(str(tmp), str(path))
+        except OSError:
+            # The cache is an optimization, never fail because of it
+            pass
+
+    def get(self, resource: str, ttl: Optional[int] = None) -> Optional[dict]:
+        """Get a resource, from the cache if it is fresh enough"""
+        url = req_sess.base_url + resource
+        if ttl is None:
+            ttl = self.ttl
+        entry = self._load(url)
+        if self.offline:
+            return entry['data'] if entry else None
+        if entry and time.time() - entry.get('fetched', 0) < ttl:
+            return entry['data']
+
+        headers = codec.accept()
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        req = req_sess.get(resource, headers=headers)
+        if req.status_code == 304 and entry:
+            entry['fetched'] = time.time()
+            self._store(url, entry)
+            return entry['data']
+        if req.status_code != 200:
+            return None
+
+        data = codec.decode(req)
+        self._store(url, dict(
+            url=url,
+            etag=req.headers.get('ETag'),
+            last_modified=req.headers.get('Last-Modified'),
+            fetched=time.time(),
+            data=data))
+        return data
+
+    def clear(self):
+        """Remove every cached entry"""
+        for path in Path(self.path).glob('*.json'):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+resource_cache = ResourceCache()
@@ -0,0 +1,240 @@
+"""
+codec.py : Encoding of API payloads
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Faster backends are used when they are installed (pip install epmanage-cli[speedups]):
+* orjson to decode and encode JSON
+* msgpack, asked to the server when enabled (Eve serves it when its msgpack renderer is on)
+* brotli, which requests then negotiates next to gzip and deflate
+The stdlib json module is used otherwise
+
+Collection pages can also be decoded while they are received (see ItemStream),
+one element of _items at a time, so that a page is never held twice in memory.
+"""
+import codecs
+import json
+import re
+from typing import Iterator, Union
+
+import requests.exceptions
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_TYPE = 'application/json'
+MSGPACK_TYPE = 'application/msgpack'
+
+DecodeError = requests.exceptions.JSONDecodeError
+
+# States of ItemScanner, the token expected next
+_START, _FIRST_KEY, _KEY, _COLON, _VALUE, _NEXT, _FIRST_ITEM, _ITEM, _NEXT_ITEM, _END = range(10)
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_decoder = json.JSONDecoder()
+
+
+class Codec(object):
+    """Content negotiation and decoding of API responses"""
+
+    def __init__(self):
+        self.msgpack = False
+
+    @property
+    def backend(self) -> str:
+        return 'orjson' if orjson else 'json'
+
+    def use_msgpack(self, enabled: bool = True) -> bool:
+        """Ask for msgpack payloads, if the module is installed"""
+        self.msgpack = enabled and msgpack is not None
+        return self.msgpack
+
+    def accept(self) -> dict:
+        """Headers of an API request"""
+        if self.msgpack:
+            return {'Accept': '{}, {};q=0.9'.format(MSGPACK_TYPE, JSON_TYPE)}
+        return {'Accept': JSON_TYPE}
+
+    @staticmethod
+    def loads(data: Union[bytes, str]):
+        if orjson:
+            return orjson.loads(data)
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(obj) -> str:
+        if orjson:
+            return orjson.dumps(obj, default=str).decode('utf-8')
+        return json.dumps(obj, default=str)
+
+    def decode(self, response):
+        """
+        Decode the body of a response according to its Content-Type.
+        Raise DecodeError (a CommException) when it is invalid, as response.json() does
+        """
+        content = response.content
+        content_type = response.headers.get('Content-Type', '')
+        try:
+            if content_type.startswith(MSGPACK_TYPE) and msgpack is not None:
+                return msgpack.unpackb(content, raw=False)
+            return self.loads(content)
+        except ValueError as exc:
+            raise DecodeError(str(exc), content[:100].decode('utf-8', 'replace'), 0)
+
+
+class ItemScanner(object):
+    """
+    Incremental parser of a JSON object: the elements of its `key` array are
+    decoded as soon as they are complete, the other members as they arrive.
+    Values are decoded by the stdlib decoder (JSONDecoder.raw_decode tells where they end),
+    one which is not complete yet is decoded again once twice as much text was received
+    """
+
+    def __init__(self, key: str = '_items'):
+        self.page = dict()  # The members of the object, `key` is an empty list
+        self._key = key
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._text = ''
+        self._chunks = []  # Text received after self._text
+        self._size = 0  # Length of the text and the chunks
+        self._pos = 0
+        self._need = 0  # Length of the text to wait for before scanning again
+        self._state = _START
+        self._member = None
+
+    def feed(self, data: bytes) -> list:
+        """Add data, return the elements it completes"""
+        try:
+            text = self._utf8.decode(data)
+        except UnicodeDecodeError as exc:
+            raise DecodeError(str(exc), '', 0)
+        self._chunks.append(text)
+        self._size += len(text)
+        if self._size - self._pos < self._need:
+            return []
+        return self._scan(False)
+
+    def close(self) -> list:
+        """End of the document: return the elements it completes, the other members are in `page`"""
+        try:
+            self._chunks.append(self._utf8.decode(b'', True))
+        except UnicodeDecodeError as exc:
+            raise DecodeError(str(exc), '', 0)
+        elements = self._scan(True)
+        if self._state != _END:
+            raise DecodeError('Truncated document', self._text[:100], len(self._text))
+        return elements
+
+    def _scan(self, final: bool) -> list:
+        text = self._text = self._text[self._pos:] + ''.join(self._chunks)
+        self._chunks = []
+        pos, end, elements = 0, len(text), []
+        self._size = end
+        self._need = 0
+        while True:
+            pos = _WHITESPACE.match(text, pos).end()
+            if pos == end:
+                break
+            char = text[pos]
+            state = self._state
+            if (state in (_FIRST_KEY, _KEY) and char == '"') or state in (_VALUE, _ITEM) or (
+                    state == _FIRST_ITEM and char != ']'):
+                if state == _VALUE and char == '[' and self._member == self._key:
+                    self.page[self._member] = []
+                    self._state = _FIRST_ITEM
+                    pos += 1
+                    continue
+                try:
+                    value, stop = _decoder.raw_decode(text, pos)
+                except ValueError as exc:
+                    if final:
+                        raise DecodeError(str(exc), text[pos:pos + 100], pos)
+                    self._need = 2 * (end - pos)
+                    break
+                if not final and (stop == end or (type(value) in (int, float) and text[stop] in '.eE+-')):
+                    # A number may go on in the next data
+                    self._need = end - pos + 1
+                    break
+                pos = stop
+                if state in (_FIRST_KEY, _KEY):
+                    self._member = value
+                    self._state = _COLON
+                elif state == _VALUE:
+                    self.page[self._member] = value
+                    self._state = _NEXT
+                else:
+                    elements.append(value)
+                    self._state = _NEXT_ITEM
+                continue
+
+            if state == _START and char == '{':
+                self._state = _FIRST_KEY
+            elif state == _COLON and char == ':':
+                self._state = _VALUE
+            elif state in (_FIRST_KEY, _NEXT) and char == '}':
+                self._state = _END
+            elif state == _NEXT and char == ',':
+                self._state = _KEY
+            elif state in (_FIRST_ITEM, _NEXT_ITEM) and char == ']':
+                self._state = _NEXT
+            elif state == _NEXT_ITEM and char == ',':
+                self._state = _ITEM
+            else:
+                raise DecodeError('Unexpected {!r}'.format(char), text[pos:pos + 100], pos)
+            pos += 1
+        self._pos = pos
+        return elements
+
+
+class ItemStream(object):
+    """
+    Items of a collection response decoded while its body is read (request it with stream=True).
+    Iterate over the items first; the rest of the page (_links, _meta) is in `page` afterwards
+    """
+
+    def __init__(self, response, chunk_size: int = 64 * 1024):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.page = None
+
+    def __iter__(self) -> Iterator[dict]:
+        if self.response.headers.get('Content-Type', '').startswith(MSGPACK_TYPE):
+            # msgpack is decoded at once
+            self.page = codec.decode(self.response)
+            items = self.page.pop('_items', [])
+            self.page['_items'] = []
+            yield from items
+            return
+
+        scanner = ItemScanner()
+        try:
+            for chunk in self.response.iter_content(self.chunk_size):
+                yield from scanner.feed(chunk)
+        except requests.exceptions.ChunkedEncodingError as exc:
+            raise DecodeError('Incomplete response: {}'.format(exc), '', 0)
+        yield from scanner.close()
+        self.page = scanner.page
+
+
+codec = Codec()
@@ -18,23 +18,67 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
-import warnings
-from collections import OrderedDict
+import email.utils
+import json
+import math
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+from typing import Callable, Iterable, Iterator, Optional, Tuple
 
-from epmanage.lib.api import req_sess
+from epmanage.lib.api import req_sess, CommException
+from epmanage.lib.codec import codec, ItemStream
+from epmanage.lib.schema import ModelSchema, ModelFields
+
+READ_ONLY_ERROR = dict(_error=dict(message='The local inventory is read-only'))
+
+# event: added, changed, removed or error; item: the EveItem (added, changed); message: the error
+WatchEvent = namedtuple('WatchEvent', ('event', 'id', 'item', 'message'))
+WatchEvent.__new__.__defaults__ = (None,)
 
 
 class EveItem(object):
-    schema = None
+    """
+    Document of a collection, without per-instance dict: subclasses declare empty __slots__.
+    Items read like a mapping of the schema fields: item['hostname'], item.get('tags'),
+    keys() in display order (computed once per model). Fields absent from the document are None.
+    An item is always true, even when its model has no schema
+    """
+    __slots__ = ('_data',)
+    _model = None
+    schema = ModelSchema()
+    fields = ModelFields()
 
     def __init__(self, data):
         self._data = data
 
+    def __getitem__(self, key):
+        return self._data.get(key)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def keys(self) -> tuple:
+        return self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+    def __bool__(self) -> bool:
+        # An item exists whatever its schema: existence checks must not load it
+        return True
+
+    def __contains__(self, key) -> bool:
+        return key in self.fields
+
     def attributes(self) -> dict:
-        out = OrderedDict()
-        for prop in sorted(self.schema.keys()):
-            out[prop] = self._data.get(prop)
-        return out
+        """Copy of the schema fields, in display order"""
+        fields = self.fields
+        return dict(zip(fields, map(self._data.get, fields)))
 
     def is_prop_read_only(self, prop: str) -> bool:
         return self.schema.get(prop, {}).get('readonly')
@@ -48,6 +92,15 @@ class EveItem(object):
         except KeyError:
             return None
 
+    @property
+    def data(self) -> dict:
+        """Raw document, as sent by the server"""
+        return self._data
+
+    @property
+    def id(self):
+        return self._data.get('_id')
+
     @property
     def etag(self):
         return self._data['_etag']
@@ -60,32 +113,223 @@ class EveAPI(object):
     def __init__(self, model, item_cls):
         self._model = model
         self._item_cls = item_cls
-        req = req_sess.get('/schema')
-        if req.status_code != 200:
-            warnings.warn('Cannot fetch schema')
-        else:
-            self._schema = req.json().get(self._model)
-            item_cls.schema = self._schema
+        self._inventory = None
+        item_cls._model = model
 
-    def list(self, filter=None) -> list:
-        params = dict()
-        if filter:
-            params = dict(filter=filter)
+    @property
+    def model(self) -> str:
+        return self._model
+
+    @property
+    def schema(self) -> dict:
+        return self._item_cls.schema
+
+    def use_inventory(self, inventory) -> 'EveAPI':
+        """
+        Answer read requests (iter, list, get, get2) from a local Inventory.
+        Write requests are refused
+        """
+        self._inventory = inventory
+        return self
+
+    def _get_page(self, params: dict, page: int) -> Optional[dict]:
         req = req_sess.get(
             '/{}'.format(self._model),
-            params=params)
+            params=dict(params, page=page),
+            headers=codec.accept())
         if req.status_code != 200:
-            return []
+            return None
+        return codec.decode(req)
+
+    @staticmethod
+    def last_page(data: dict, current: int) -> Optional[int]:
+        """Number of the last page of a collection, if it can be known from one of its pages"""
+        if 'next' not in data.get('_links', {}):
+            return current
+        meta = data.get('_meta', {})
+        if meta.get('total') and meta.get('max_results'):
+            return math.ceil(meta['total'] / meta['max_results'])
+        return None
+
+    def iter(self, filter=None, max_results: Optional[int] = None, jobs: int = 1,
+             where=None, projection: Optional[Iterable[str]] = None, stream: bool = False) -> Iterator[EveItem]:
+        """
+        Iterate over every item of the collection, following the pagination.
+        Up to `jobs` pages are fetched in the background while the current one
+        is consumed; items are always yielded in page order.
+        `where` is an Eve query, either a string or a dict (MongoDB syntax).
+        `projection` limits the fields sent by the server (meta fields are always included).
+        With `stream`, pages are fetched one at a time and their items yielded while
+        the page is received, so that memory does not grow with the size of the pages
+        """
+        if self._inventory is not None:
+            if where:
+                raise ValueError('Queries are not supported by the local inventory')
+            return (self._item_cls(x) for x in self._inventory.iter(self._model, filter))
+        if stream:
+            return self._iter_stream(self._params(filter, max_results, where, projection))
+        return self._iter_remote(filter, max_results, jobs, where, projection)
+
+    def _iter_stream(self, params: dict) -> Iterator[EveItem]:
+        page = 1
+        while True:
+            req = req_sess.get(
+                '/{}'.format(self._model),
+                params=dict(params, page=page),
+                headers=codec.accept(),
+                stream=True)
+            try:
+                if req.status_code != 200:
+                    if page == 1:
+                        return
+                    raise CommException('Cannot fetch page {} of {}'.format(page, self._model))
+                items = ItemStream(req)
+                for item in items:
+                    yield self._item_cls(item)
+            finally:
+                req.close()
+            if 'next' not in items.page.get('_links', {}):
+                return
+            page += 1
+
+    @staticmethod
+    def _params(filter=None, max_results: Optional[int] = None, where=None,
+                projection: Optional[Iterable[str]] = None) -> dict:
+        """Query string parameters of a collection request"""
+        params = dict()
+        if filter:
+            params['filter'] = filter
+        if where:
+            params['where'] = where if isinstance(where, str) else json.dumps(where)
+        if projection:
+            params['projection'] = json.dumps({x: 1 for x in projection})
+        if max_results:
+            params['max_results'] = max_results
+        return params
 
-        items = req.json().get('_items')
+    def _iter_remote(self, filter, max_results, jobs, where, projection) -> Iterator[EveItem]:
+        params = self._params(filter, max_results, where, projection)
+        page = 1  # Last page requested
+        last = None  # Last page of the collection, if the server tells us
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            pending = deque([(page, executor.submit(self._get_page, params, page))])
+            while pending:
+                current, future = pending.popleft()
+                data = future.result()
+                if data is None:
+                    if current == 1:
+                        return
+                    raise CommException('Cannot fetch page {} of {}'.format(current, self._model))
 
-        return [self._item_cls(item) for item in items]
+                if last is None or 'next' not in data.get('_links', {}):
+                    last = self.last_page(data, current)
+
+                if last is None:
+                    if page == current and 'next' in data.get('_links', {}):
+                        page += 1
+                        pending.append((page, executor.submit(self._get_page, params, page)))
+                else:
+                    while page < last and len(pending) < jobs:
+                        page += 1
+                        pending.append((page, executor.submit(self._get_page, params, page)))
+
+                for item in data.get('_items', []):
+                    yield self._item_cls(item)
+
+    def watch(self, where=None, projection: Optional[Iterable[str]] = None, interval: float = 2.0,
+              max_interval: float = 60.0, scan_interval: float = 300.0, initial: bool = False,
+              max_results: Optional[int] = None, jobs: int = 4) -> Iterator[WatchEvent]:
+        """
+        Poll the collection forever, yield a WatchEvent for every item added, changed or removed.
+        Only items updated since the newest one seen are requested, and the first page is
+        revalidated with its ETag: without changes a poll costs a 304 or an empty page.
+        The polling interval doubles after each poll without change, up to max_interval.
+        Removals are detected by listing the ids every scan_interval seconds (0: never).
+        Polls which fail yield an `error` event and are retried after max_interval
+        """
+        if self._inventory is not None:
+            raise ValueError('The local inventory cannot be watched')
+        where = json.loads(where) if isinstance(where, str) else dict(where or {})
+        if '_updated' in where:
+            raise ValueError('_updated is used by watch, it cannot be part of the query')
+
+        known = dict()  # id -> etag
+        watermark = None  # _updated of the newest item
+        for item in self._iter_remote(None, max_results, jobs, where, projection if initial else ('_id',)):
+            known[item.id] = item.etag
+            watermark = latest(watermark, item.data.get('_updated'))
+            if initial:
+                yield WatchEvent('added', item.id, item)
+
+        settled = False  # Whether the server clock passed the watermark: nothing else can have its date
+        etag = None  # Of the first page of the last query
+        query = None
+        scanned = time.monotonic()
+        delay = interval
+        while True:
+            time.sleep(delay)
+            events = []
+            try:
+                params = self._params(max_results=max_results, projection=projection, where=dict(
+                    where, _updated={'$gt' if settled else '$gte': watermark}) if watermark else where)
+                if params != query:
+                    query, etag = params, None
+                req = req_sess.get(
+                    '/{}'.format(self._model),
+                    params=dict(params, page=1),
+                    headers=dict(codec.accept(), **({'If-None-Match': etag} if etag else {})))
+                if req.status_code not in (200, 304):
+                    raise CommException('Cannot poll {} (HTTP {})'.format(self._model, req.status_code))
+
+                if req.status_code == 200:
+                    # Every page is fetched before the state changes, a failure must not move the watermark
+                    data, page = codec.decode(req), 1
+                    items = data.get('_items', [])
+                    while 'next' in data.get('_links', {}):
+                        page += 1
+                        data = self._get_page(params, page)
+                        if data is None:
+                            raise CommException('Cannot fetch page {} of {}'.format(page, self._model))
+                        items.extend(data.get('_items', []))
+
+                    etag = req.headers.get('ETag')
+                    for item in map(self._item_cls, items):
+                        if known.get(item.id) != item.etag:
+                            events.append(WatchEvent('changed' if item.id in known else 'added', item.id, item))
+                            known[item.id] = item.etag
+                        watermark = latest(watermark, item.data.get('_updated'))
+                    date = req.headers.get('Date')
+                    settled = bool(date and watermark) and \
+                        email.utils.parsedate_to_datetime(date) > email.utils.parsedate_to_datetime(watermark)
+
+                if scan_interval and time.monotonic() - scanned >= scan_interval:
+                    remote = frozenset(x.id for x in self._iter_remote(None, max_results, jobs, where, ('_id',)))
+                    for item_id in [x for x in known if x not in remote]:
+                        del known[item_id]
+                        events.append(WatchEvent('removed', item_id, None))
+                    scanned = time.monotonic()
+            except CommException as exc:
+                yield WatchEvent('error', None, None, str(exc))
+                delay = max_interval
+                continue
+
+            for event in events:
+                yield event
+            delay = interval if events else min(delay * 2, max_interval)
+
+    def list(self, filter=None, projection: Optional[Iterable[str]] = None) -> list:
+        return list(self.iter(filter, projection=projection))
 
     def get(self, info):
-        req = req_sess.get('/{}/{}'.format(self._model, info))
+        if self._inventory is not None:
+            data = self._inventory.get(self._model, info)
+            if not data:
+                return None, dict(_error=dict(code=404, message='Not found in the local inventory'))
+            return self._item_cls(data), None
+        req = req_sess.get('/{}/{}'.format(self._model, info), headers=codec.accept())
         if req.status_code != 200:
-            return None, req.json()
-        return self._item_cls(req.json()), None
+            return None, codec.decode(req)
+        return self._item_cls(codec.decode(req)), None
 
     def get2(self, attr, value):
         items = self.list('{}={}'.format(attr, value))
@@ -93,25 +337,118 @@ class EveAPI(object):
             return items[0]
 
     def patch(self, item: EveItem, params: dict):
+        if self._inventory is not None:
+            return False, READ_ONLY_ERROR
         req = req_sess.patch(
             '/{}'.format(item.get_url()),
             json=params,
-            headers={
+            headers=dict(codec.accept(), **{
                 'If-Match': item.etag
-            })
+            }))
         if req.status_code == 200:
-            item.update(req.json())
+            item.update(codec.decode(req))
             return True, None
         else:
-            return False, req.json()
+            return False, codec.decode(req)
+
+    def refresh(self, item: EveItem) -> bool:
+        """Reload an item from the server"""
+        req = req_sess.get('/{}'.format(item.get_url()), headers=codec.accept())
+        if req.status_code != 200:
+            return False
+        item.update(codec.decode(req))
+        return True
+
+    def retry_conditional(self, method: Callable, item: EveItem, *args, retries: int = 2,
+                          check: Optional[Callable[[EveItem], bool]] = None):
+        """
+        Call a conditional method (patch, delete) on an item.
+        When the item changed on the server (412), reload it and try again,
+        unless `check` rejects the reloaded item: the 412 error is then returned
+        """
+        for _ in range(retries):
+            ret, error = method(item, *args)
+            if ret or not is_precondition_failed(error) or not self.refresh(item):
+                return ret, error
+            if check is not None and not check(item):
+                return ret, error
+        return method(item, *args)
+
+    def patch_many(self, items: Iterable[EveItem], params: dict, jobs: int = 8,
+                   retries: int = 2) -> Iterator[Tuple[EveItem, Optional[dict]]]:
+        """PATCH every item concurrently, yield (item, error) as they complete"""
+        def patch(item):
+            return item, self.retry_conditional(self.patch, item, params, retries=retries)[1]
+
+        return run_many(patch, items, jobs)
+
+    def delete_many(self, items: Iterable[EveItem], jobs: int = 8, retries: int = 2,
+                    check: Optional[Callable[[EveItem], bool]] = None) -> Iterator[Tuple[EveItem, Optional[dict]]]:
+        """
+        DELETE every item concurrently, yield (item, error) as they complete.
+        An item changed since it was listed (412) is not deleted: the error is yielded,
+        unless `check` still accepts the reloaded item, which is then deleted
+        """
+        def delete(item):
+            return item, self.retry_conditional(self.delete, item, retries=retries if check else 0, check=check)[1]
+
+        return run_many(delete, items, jobs)
 
     def delete(self, item: EveItem):
+        if self._inventory is not None:
+            return False, READ_ONLY_ERROR
         req = req_sess.delete(
             '/{}'.format(item.get_url()),
-            headers={
+            headers=dict(codec.accept(), **{
                 'If-Match': item.etag
-            })
+            }))
         if req.status_code == 204:
             return True, None
         else:
-            return False, req.json()
+            return False, codec.decode(req)
+
+
+def latest(first: Optional[str], second: Optional[str]) -> Optional[str]:
+    """Most recent of two Eve dates, either may be None"""
+    if not first or not second:
+        return first or second
+    return second if parse_eve_date(second) > parse_eve_date(first) else first
+
+
+def parse_eve_date(value: str) -> datetime:
+    """Read a date sent by Eve (RFC 1123)"""
+    return email.utils.parsedate_to_datetime(value)
+
+
+def eve_date(date: datetime) -> str:
+    """Format a datetime the way Eve expects it in queries (RFC 1123)"""
+    return email.utils.format_datetime(date.astimezone(timezone.utc), usegmt=True)
+
+
+def is_precondition_failed(error: Optional[dict]) -> bool:
+    return bool(error) and error.get('_error', {}).get('code') == 412
+
+
+def run_many(func: Callable, items: Iterable, jobs: int) -> Iterator:
+    """
+    Call func on every item with a bounded thread pool, yield results as they complete.
+    A func raising CommException produces (item, {'_error': {'message': ...}})
+    """
+    def call(item):
+        try:
+            return func(item)
+        except CommException as exc:
+            return item, dict(_error=dict(message=str(exc)))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = set()
+        for item in items:
+            if len(pending) >= jobs * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(call, item))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
@@ -0,0 +1,145 @@
+"""
+inventory.py : Local SQLite inventory
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import email.utils
+import re
+import sqlite3
+import time
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+from epmanage.lib.api import req_sess
+from epmanage.lib.codec import codec
+
+# Attributes looked up by get/get2, indexed for each model
+LOOKUPS = dict(
+    agent=('uuid', 'hostname'),
+    user=('email',),
+    app=('name',),
+)
+
+
+def _json_path(attr: str) -> str:
+    if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', attr):
+        raise ValueError('Invalid attribute "{}"'.format(attr))
+    return '$.{}'.format(attr)
+
+
+class Inventory(object):
+    """
+    Local mirror of the Eve collections.
+    Documents are stored as JSON, with indexes on the attributes of LOOKUPS
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path))
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS items ('
+                'model TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (model, id))')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS sync ('
+                'model TEXT PRIMARY KEY, url TEXT, watermark TEXT, synced REAL)')
+            for attrs in LOOKUPS.values():
+                for attr in attrs:
+                    self._db.execute(
+                        "CREATE INDEX IF NOT EXISTS items_{0} ON items (model, json_extract(data, '$.{0}'))".format(
+                            attr))
+
+    def close(self):
+        self._db.close()
+
+    @property
+    def url(self) -> Optional[str]:
+        """Base URL of the server the inventory mirrors"""
+        row = self._db.execute('SELECT url FROM sync LIMIT 1').fetchone()
+        return row[0] if row else None
+
+    def status(self, model: str) -> Tuple[Optional[str], Optional[float]]:
+        """(watermark, time of the last sync) of a model"""
+        row = self._db.execute('SELECT watermark, synced FROM sync WHERE model = ?', (model,)).fetchone()
+        return row if row else (None, None)
+
+    def sync(self, api, jobs: int = 4, full: bool = False, deletions: bool = True,
+             stream: bool = False) -> Tuple[int, int]:
+        """
+        Synchronize a model from an EveAPI, return the number of (updated, deleted) documents.
+        Only documents updated since the last synchronization are fetched; deletions
+        are detected by listing the remote ids. `stream` decodes each page while it is received
+        """
+        model = api.model
+        watermark, _ = self.status(model)
+        if full or self.url not in (None, req_sess.base_url):
+            watermark = None
+        where = {'_updated': {'$gte': watermark}} if watermark else None
+
+        newest = watermark
+        updated = deleted = 0
+        with self._db:
+            if not watermark:
+                self._db.execute('DELETE FROM items WHERE model = ?', (model,))
+            for item in api.iter(where=where, jobs=jobs, stream=stream):
+                self._db.execute(
+                    'INSERT OR REPLACE INTO items (model, id, data) VALUES (?, ?, ?)',
+                    (model, item.id, codec.dumps(item.data)))
+                updated += 1
+                stamp = item.data.get('_updated')
+                if stamp and (not newest or
+                              email.utils.parsedate_to_datetime(stamp) > email.utils.parsedate_to_datetime(newest)):
+                    newest = stamp
+
+            if watermark and deletions:
+                remote = frozenset(x.id for x in api.iter(jobs=jobs, projection=('_id',)))
+                local = [row[0] for row in self._db.execute('SELECT id FROM items WHERE model = ?', (model,))]
+                for item_id in local:
+                    if item_id not in remote:
+                        self._db.execute('DELETE FROM items WHERE model = ? AND id = ?', (model, item_id))
+                        deleted += 1
+
+            self._db.execute(
+                'INSERT OR REPLACE INTO sync (model, url, watermark, synced) VALUES (?, ?, ?, ?)',
+                (model, req_sess.base_url, newest, time.time()))
+        return updated, deleted
+
+    def iter(self, model: str, filter: Optional[str] = None) -> Iterator[dict]:
+        """Iterate over the documents of a model; filter is "attr=value", like the server"""
+        if filter:
+            attr, _, value = filter.partition('=')
+            cursor = self._db.execute(
+                "SELECT data FROM items WHERE model = ? AND json_extract(data, '{}') = ? ORDER BY rowid".format(
+                    _json_path(attr)),
+                (model, value))
+        else:
+            cursor = self._db.execute('SELECT data FROM items WHERE model = ? ORDER BY rowid', (model,))
+        for row in cursor:
+            yield codec.loads(row[0])
+
+    def get(self, model: str, info: str) -> Optional[dict]:
+        """Get a document by id or by one of its lookup attributes"""
+        row = self._db.execute('SELECT data FROM items WHERE model = ? AND id = ?', (model, info)).fetchone()
+        for attr in LOOKUPS.get(model, ()):
+            if row:
+                break
+            row = self._db.execute(
+                "SELECT data FROM items WHERE model = ? AND json_extract(data, '$.{}') = ?".format(attr),
+                (model, info)).fetchone()
+        return codec.loads(row[0]) if row else None
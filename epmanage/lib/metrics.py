@@ -0,0 +1,189 @@
+"""
+metrics.py : Latency and throughput of the API requests
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Usage from the library:
+    from epmanage.lib.api import req_sess
+    from epmanage.lib.metrics import metrics
+    metrics.attach(req_sess)
+    ...
+    print(metrics.summary())
+"""
+import math
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+from typing import Optional
+from urllib.parse import urlsplit
+
+Sample = namedtuple('Sample', ('status', 'latency', 'ttfb', 'bytes_in', 'bytes_out', 'retries'))
+
+# Path segments replaced by {id} in endpoint names: numbers, object ids, uuids, emails
+ID_SEGMENT = re.compile(r'^(\d+|[0-9a-fA-F]{16,}|[0-9a-fA-F-]{32,36}|[^@/]+@[^@/]+)$')
+
+
+def endpoint(method: str, url: str) -> str:
+    """Name of the endpoint of a request, e.g. GET /agent/{id}"""
+    path = urlsplit(url).path
+    segments = ['{id}' if ID_SEGMENT.match(x) else x for x in path.split('/')]
+    return '{} {}'.format(method.upper(), '/'.join(segments) or '/')
+
+
+def percentile(values: list, rank: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(rank / 100 * len(values)) - 1)]
+
+
+class Metrics(object):
+    """
+    Thread-safe record of the requests sent by the sessions it is attached to.
+    Latency covers the whole response (body included, unless it is streamed),
+    TTFB stops when the response headers are received.
+    Attachments are counted: the samples are dropped once every attachment is detached,
+    so that a long running process (the daemon) does not keep them between commands
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = dict()  # endpoint -> [Sample]
+        self._errors = Counter()  # endpoint -> requests without response
+        self._attached = Counter()  # id(session) -> attachments
+
+    def attach(self, session):
+        """Record the requests of a requests.Session, until it is detached as many times"""
+        with self._lock:
+            self._attached[id(session)] += 1
+        if self.on_response not in session.hooks['response']:
+            session.hooks['response'].append(self.on_response)
+        session.metrics = self
+
+    def detach(self, session):
+        with self._lock:
+            self._attached[id(session)] -= 1
+            if self._attached[id(session)] > 0:
+                return
+            del self._attached[id(session)]
+            if not self._attached:
+                self._samples.clear()
+                self._errors.clear()
+        if self.on_response in session.hooks['response']:
+            session.hooks['response'].remove(self.on_response)
+        if getattr(session, 'metrics', None) is self:
+            session.metrics = None
+
+    def on_response(self, response, *args, **kwargs):
+        """requests response hook"""
+        ttfb = response.elapsed.total_seconds()
+        latency = ttfb
+        if kwargs.get('stream'):
+            bytes_in = int(response.headers.get('Content-Length') or 0)
+        else:
+            # requests reads the body right after the hooks, do it here to time it
+            start = time.perf_counter()
+            content = response.content
+            latency += time.perf_counter() - start
+            tell = getattr(response.raw, 'tell', None)
+            bytes_in = (tell() if tell else 0) or len(content or b'')
+
+        body = response.request.body
+        retries = getattr(response.raw, 'retries', None)
+        self.record(response.request.method, response.request.url, Sample(
+            status=response.status_code,
+            latency=latency,
+            ttfb=ttfb,
+            bytes_in=bytes_in,
+            bytes_out=len(body) if body else 0,
+            retries=len(retries.history) if retries and retries.history else 0))
+        return response
+
+    def record(self, method: str, url: str, sample: Sample):
+        name = endpoint(method, url)
+        with self._lock:
+            self._samples.setdefault(name, []).append(sample)
+
+    def error(self, method: str, url: str):
+        """Count a request which got no response"""
+        with self._lock:
+            self._errors[endpoint(method, url)] += 1
+
+    def mark(self) -> dict:
+        """Current position, to get the metrics of the requests sent after it (see snapshot)"""
+        with self._lock:
+            return dict(samples={key: len(value) for key, value in self._samples.items()}, errors=dict(self._errors))
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._errors.clear()
+
+    def snapshot(self, since: Optional[dict] = None) -> dict:
+        """Metrics per endpoint and in total, of every request or of the ones after a mark"""
+        since = since or dict(samples={}, errors={})
+        with self._lock:
+            samples = {key: value[since['samples'].get(key, 0):] for key, value in self._samples.items()}
+            errors = {key: value - since['errors'].get(key, 0) for key, value in self._errors.items()}
+
+        endpoints = dict()
+        for name in sorted(set(samples) | set(errors)):
+            data = self._summarize(samples.get(name, []))
+            data['errors'] = errors.get(name, 0)
+            if data['requests'] or data['errors']:
+                endpoints[name] = data
+        total = self._summarize([x for value in samples.values() for x in value])
+        total['errors'] = sum(errors.values())
+        return dict(endpoints=endpoints, total=total)
+
+    @staticmethod
+    def _summarize(samples: list) -> dict:
+        latencies = sorted(x.latency for x in samples)
+        ttfbs = sorted(x.ttfb for x in samples)
+        return dict(
+            requests=len(samples),
+            status=dict(sorted(Counter(str(x.status) for x in samples).items())),
+            retries=sum(x.retries for x in samples),
+            bytes_in=sum(x.bytes_in for x in samples),
+            bytes_out=sum(x.bytes_out for x in samples),
+            time=sum(latencies),
+            p50=percentile(latencies, 50),
+            p95=percentile(latencies, 95),
+            p99=percentile(latencies, 99),
+            ttfb_p50=percentile(ttfbs, 50),
+            ttfb_p95=percentile(ttfbs, 95))
+
+    def summary(self, since: Optional[dict] = None) -> str:
+        """Human readable table of the snapshot"""
+        data = self.snapshot(since)
+        lines = ['{:<32} {:>6} {:>8} {:>8} {:>8} {:>8} {:>10} {:>9} {:>7}  {}'.format(
+            'endpoint', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'ttfb ms', 'bytes in', 'bytes out', 'retries',
+            'status')]
+        rows = list(data['endpoints'].items()) + [('total', data['total'])]
+        for name, value in rows:
+            status = ' '.join('{}:{}'.format(key, count) for key, count in value['status'].items())
+            if value['errors']:
+                status = '{} error:{}'.format(status, value['errors']).strip()
+            lines.append('{:<32} {:>6} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>10,} {:>9,} {:>7}  {}'.format(
+                name, value['requests'], value['p50'] * 1000, value['p95'] * 1000, value['p99'] * 1000,
+                value['ttfb_p50'] * 1000, value['bytes_in'], value['bytes_out'], value['retries'], status))
+        return '\n'.join(lines)
+
+
+metrics = Metrics()
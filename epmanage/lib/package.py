@@ -19,56 +19,259 @@ You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import hashlib
+import json
+import os
 import re
-from typing import Optional
+from collections import namedtuple
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
 
-from epmanage.lib.api import req_sess
+from epmanage.lib.api import req_sess, CommException
+from epmanage.lib.cache import resource_cache
+from epmanage.lib.eve_api import run_many
 
+CHUNK_SIZE = 64 * 1024
 
-class PackageAPI(object):
-    def __init__(self):
-        pass
+MANIFEST = 'manifest.json'
 
-    def list(self) -> list:
-        req = req_sess.get('/frontend/packages')
-        if req.status_code != 200:
-            return []
+PackageFile = namedtuple('PackageFile', ['path', 'sha256', 'etag'])
 
-        items = req.json().get('data')
-        return items
 
-    def download(self, os: str, osversion: Optional[str], arch: Optional[str], choose_callback=None):
-        items = self.list()
-        try:
-            item = next(x for x in items if x.get('os') == os)
-        except StopIteration:
-            item = None
-        if not item:
+def version_key(version: Optional[str]) -> tuple:
+    """Sort key ordering versions naturally (10 > 9, debian9 > debian8)"""
+    return tuple((0, int(x), '') if x.isdigit() else (1, 0, x)
+                 for x in re.findall(r'\d+|[^\d.]+', version or ''))
+
+
+class PackageCatalog(object):
+    """Package catalog indexed by (os, osversion, arch)"""
+
+    def __init__(self, items: list):
+        self.items = items
+        self._index = dict()
+        self._versions = dict()
+        for item in items:
+            os_name = item.get('os')
+            self._versions.setdefault(os_name, set())
+            for pkg in item.get('packages') or []:
+                osversion, arch = pkg.get('osversion'), pkg.get('arch')
+                self._versions[os_name].add(osversion)
+                for key in {(osversion, arch), (osversion, None), (None, arch), (None, None)}:
+                    self._index.setdefault((os_name,) + key, []).append(pkg)
+
+    def latest(self, os: str) -> Optional[str]:
+        """Most recent OS version having a package"""
+        versions = [x for x in self._versions.get(os, ()) if x]
+        return max(versions, key=version_key) if versions else None
+
+    def find(self, os: str, osversion: Optional[str] = None, arch: Optional[str] = None) -> list:
+        """Packages matching the filters; osversion may be 'latest'"""
+        if os not in self._versions:
             raise ValueError('Unknown os "{}"'.format(os))
+        if osversion == 'latest':
+            osversion = self.latest(os)
+        return self._index.get((os, osversion or None, arch or None), [])
 
-        pkgs = []
-        for pkg in item.get('packages'):
-            if osversion and pkg.get('osversion') != osversion:
-                continue
-            if arch and pkg.get('arch') != arch:
-                continue
-            pkgs.append(pkg)
+    def select(self, os: str, osversion: Optional[str], arch: Optional[str], choose_callback=None) -> dict:
+        """Select a single package"""
+        pkgs = self.find(os, osversion, arch)
         if len(pkgs) == 0:
             raise ValueError('No package found')
         elif len(pkgs) == 1:
-            pkg = pkgs[0]
+            return pkgs[0]
         elif callable(choose_callback):
             index = choose_callback(pkgs)
-            pkg = pkgs[index]
+            return pkgs[index]
         else:
             raise ValueError('More than one package match')
 
-        req = req_sess.get('{}'.format(pkg['url']))
-        if req.status_code != 200:
-            raise ValueError('Cannot download package')
 
-        fname = re.findall("filename=([^/]+)", req.headers.get('content-disposition', ''))
+class PackageAPI(object):
+    def __init__(self, catalog_ttl: int = 0):
+        self._catalog_ttl = catalog_ttl
+        self._catalog = None
+
+    def catalog(self) -> PackageCatalog:
+        """
+        The catalog is cached on disk and revalidated with its ETag once per
+        instance, at most every catalog_ttl seconds
+        """
+        if self._catalog is None:
+            data = resource_cache.get('/frontend/packages', self._catalog_ttl)
+            self._catalog = PackageCatalog((data or {}).get('data') or [])
+        return self._catalog
+
+    def list(self) -> list:
+        return self.catalog().items
+
+    @staticmethod
+    def select(items: list, os: str, osversion: Optional[str], arch: Optional[str], choose_callback=None) -> dict:
+        """Select a single package from the catalog"""
+        return PackageCatalog(items).select(os, osversion, arch, choose_callback)
+
+    @staticmethod
+    def filename(headers) -> str:
+        fname = re.findall("filename=([^/]+)", headers.get('content-disposition', ''))
         if len(fname) != 1:
             raise ValueError('Invalid response from server (no filename)')
-        fname = fname[0]
-        return fname, req.content
+        return fname[0]
+
+    @staticmethod
+    def _hash_file(path: Path, digest):
+        with path.open('rb') as ifile:
+            for chunk in iter(lambda: ifile.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+    def _fetch_once(self, pkg: dict, directory: Path, part: Path, validator: Path,
+                    etag: Optional[str]) -> Optional[PackageFile]:
+        headers = {'Accept-Encoding': 'identity'}
+        if part.exists() and validator.exists():
+            headers['Range'] = 'bytes={}-'.format(part.stat().st_size)
+            headers['If-Range'] = validator.read_text()
+        elif etag:
+            headers['If-None-Match'] = etag
+
+        with req_sess.get('{}'.format(pkg['url']), headers=headers, stream=True) as req:
+            digest = hashlib.sha256()
+            if req.status_code == 304 and etag:
+                return None
+            elif req.status_code == 206:
+                if not req.headers.get('content-range', '').startswith('bytes {}-'.format(part.stat().st_size)):
+                    part.unlink()
+                    raise CommException('Unexpected range, restarting the download')
+                self._hash_file(part, digest)
+                mode = 'ab'
+            elif req.status_code == 200:
+                mode = 'wb'
+            elif req.status_code == 416 and 'Range' in headers:
+                # The partial file is already complete, or longer than the package now is:
+                # its name is not known without a full response, download it again
+                req.close()
+                part.unlink()
+                validator.unlink()
+                return self._fetch_once(pkg, directory, part, validator, etag)
+            else:
+                raise ValueError('Cannot download package')
+
+            fname = Path(self.filename(req.headers)).name
+            etag = req.headers.get('etag')
+            if etag or req.headers.get('last-modified'):
+                validator.write_text(etag or req.headers.get('last-modified'))
+            elif validator.exists():
+                validator.unlink()
+
+            with part.open(mode) as ofile:
+                for chunk in req.iter_content(CHUNK_SIZE):
+                    ofile.write(chunk)
+                    digest.update(chunk)
+
+        path = directory / fname
+        os.replace(str(part), str(path))
+        if validator.exists():
+            validator.unlink()
+        return PackageFile(path, digest.hexdigest(), etag)
+
+    def fetch(self, pkg: dict, directory: Path = Path('.'), retries: int = 3,
+              etag: Optional[str] = None) -> Optional[PackageFile]:
+        """
+        Stream a package to a file in directory.
+        Data is written to a partial file renamed once complete; a partial file
+        left by an interrupted download is resumed with a Range request.
+        Returns None if etag is given and the package did not change
+        """
+        directory = Path(directory)
+        part = directory / '.{}.part'.format(hashlib.sha1(pkg['url'].encode()).hexdigest())
+        validator = part.with_suffix('.validator')
+        for attempt in range(retries + 1):
+            try:
+                return self._fetch_once(pkg, directory, part, validator, etag)
+            except CommException:
+                if attempt == retries:
+                    raise
+
+    def download(self, os: str, osversion: Optional[str], arch: Optional[str], choose_callback=None,
+                 directory: Path = Path('.')) -> PackageFile:
+        pkg = self.catalog().select(os, osversion, arch, choose_callback)
+        return self.fetch(pkg, directory)
+
+    def mirror(self, directory: Path, jobs: int = 4, verify: bool = False,
+               delete: bool = False) -> Iterator[Tuple[dict, str]]:
+        """
+        Synchronize every package of the catalog into directory, yield (package, status) as they complete.
+        A manifest records what was downloaded: packages whose catalog date, size
+        (and hash, with verify) did not change are skipped without any request.
+        Packages removed from the catalog are deleted with delete, reported as obsolete otherwise
+        """
+        directory = Path(directory)
+        manifest_path = directory / MANIFEST
+        try:
+            manifest = json.loads(manifest_path.read_text())
+        except (OSError, ValueError):
+            manifest = dict()
+
+        pkgs = []
+        for item in self.list():
+            for pkg in item.get('packages'):
+                pkgs.append(dict(pkg, os=item.get('os'), date=item.get('date')))
+        urls = frozenset(x['url'] for x in pkgs)
+        removed = [x for x in manifest if x not in urls]
+
+        def sync(pkg):
+            entry = previous = manifest.get(pkg['url'])
+            path = directory / entry['file'] if entry else None
+            if entry and not path.is_file():
+                entry = None
+            elif entry and path.stat().st_size != entry['size']:
+                entry = None
+            elif entry and verify:
+                digest = hashlib.sha256()
+                self._hash_file(path, digest)
+                if digest.hexdigest() != entry['sha256']:
+                    entry = None
+            if entry and entry['date'] == pkg['date']:
+                return pkg, 'unchanged'
+
+            try:
+                result = self.fetch(pkg, directory, etag=entry.get('etag') if entry else None)
+            except (ValueError, OSError) as exc:
+                return pkg, 'failed: {}'.format(exc)
+            if result is None:
+                entry['date'] = pkg['date']
+                return pkg, 'unchanged'
+            manifest[pkg['url']] = dict(
+                file=result.path.name,
+                os=pkg['os'],
+                date=pkg['date'],
+                size=result.path.stat().st_size,
+                sha256=result.sha256,
+                etag=result.etag)
+            if previous and previous['file'] != result.path.name:
+                # The new version has another name: the old file is not tracked anymore
+                try:
+                    (directory / previous['file']).unlink()
+                except OSError:
+                    pass
+            return pkg, 'downloaded'
+
+        try:
+            for pkg, status in run_many(sync, pkgs, jobs):
+                if isinstance(status, dict):
+                    status = 'failed: {}'.format(status.get('_error', {}).get('message'))
+                yield pkg, status
+            for url in removed:
+                entry = manifest[url]
+                path = directory / entry['file']
+                if not path.is_file():
+                    del manifest[url]
+                elif delete:
+                    path.unlink()
+                    del manifest[url]
+                    yield dict(name=entry['file'], os=entry['os']), 'deleted'
+                else:
+                    # Kept in the manifest, so that a later run with delete removes it
+                    yield dict(name=entry['file'], os=entry['os']), 'obsolete'
+        finally:
+            tmp = manifest_path.with_name(MANIFEST + '.tmp')
+            tmp.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+            os.replace(str(tmp), str(manifest_path))
@@ -0,0 +1,111 @@
+"""
+schema.py : Shared API schema registry
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+import time
+import warnings
+
+from epmanage.lib.api import req_sess
+from epmanage.lib.cache import resource_cache
+
+
+class SchemaRegistry(object):
+    """
+    Process-wide view of the /schema resource.
+    The schema is only fetched the first time a model needs it, then shared.
+    Processes running several invocations (shell, daemon) call expire() at the start
+    of each one: the schema is then revalidated on its next use, at most once per
+    invocation, or once it is older than max_age when it is set (the daemon)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._url = None
+        self._schema = None
+        self._loaded = 0
+        self._expired = False
+        self._fields = dict()  # model -> field names, for the current schema
+        self.max_age = None  # Seconds the schema is kept across invocations, None: revalidated by every invocation
+
+    def _valid(self) -> bool:
+        return self._schema is not None and not self._expired and self._url == req_sess.base_url
+
+    def expire(self):
+        """Start of an invocation: revalidate the schema on its next use, unless it is younger than max_age"""
+        if self.max_age is None or time.monotonic() - self._loaded > self.max_age:
+            self._expired = True
+
+    def load(self) -> dict:
+        if self._valid():
+            return self._schema
+        with self._lock:
+            if not self._valid():
+                schema = resource_cache.get('/schema')
+                if schema is None:
+                    warnings.warn('Cannot fetch schema')
+                    schema = dict()
+                self._store(schema)
+            return self._schema
+
+    def _store(self, schema: dict):
+        self._url = req_sess.base_url
+        self._schema = schema
+        self._fields = dict()
+        self._loaded = time.monotonic()
+        self._expired = False
+
+    def set(self, schema: dict):
+        """Register a schema fetched by other means (e.g. the asyncio client)"""
+        with self._lock:
+            self._store(schema)
+
+    def get(self, model: str) -> dict:
+        return self.load().get(model) or dict()
+
+    def fields(self, model: str) -> tuple:
+        """Field names of a model in display order, computed once per schema"""
+        schema = self.load()
+        fields = self._fields.get(model)
+        if fields is None:
+            fields = self._fields[model] = tuple(sorted(schema.get(model) or ()))
+        return fields
+
+    def reset(self):
+        with self._lock:
+            self._url = None
+            self._schema = None
+            self._fields = dict()
+
+
+class ModelSchema(object):
+    """Descriptor resolving the schema of an item class on first access"""
+
+    def __get__(self, instance, owner) -> dict:
+        return schema_registry.get(owner._model)
+
+
+class ModelFields(object):
+    """Descriptor giving the field names of an item class, in display order"""
+
+    def __get__(self, instance, owner) -> tuple:
+        return schema_registry.fields(owner._model)
+
+
+schema_registry = SchemaRegistry()
@@ -0,0 +1,139 @@
+"""
+search.py : In-memory text search over items
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Usage from the library:
+    index = SearchIndex(lambda agent: [agent.data.get('hostname'), agent.data.get('uuid')])
+    index.extend(AgentAPI().iter())
+    index.search('web-01')
+"""
+import threading
+from collections import Counter
+from typing import Callable, Iterable, Optional
+
+# Share of the trigrams of a term a key must contain to match it approximately
+FUZZY_RATIO = 0.5
+
+
+def trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex(object):
+    """
+    Trigram and prefix index over the keys of items (hostname, uuid...).
+    Every term of a query must match: terms of 1 or 2 characters match the
+    start of a key, longer terms match anywhere in a key, or approximately
+    (shared trigrams) when no key contains them.
+    Distinct keys are indexed once, values shared by many items (os, tags) cost one entry per item.
+    Items can be added while the index is searched from another thread
+    """
+
+    def __init__(self, keys: Callable[[object], Iterable[str]]):
+        self._keys = keys
+        self._lock = threading.Lock()
+        self._items = []
+        self._key_ids = dict()  # key -> key id
+        self._key_texts = []  # key id -> key
+        self._key_items = []  # key id -> [item]
+        self._trigrams = dict()  # trigram -> [key id]
+        self._prefixes = dict()  # first 1 or 2 characters -> [key id]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _key_id(self, key: str) -> int:
+        kid = self._key_ids.get(key)
+        if kid is None:
+            kid = self._key_ids[key] = len(self._key_texts)
+            self._key_texts.append(key)
+            self._key_items.append([])
+            for prefix in {key[:1], key[:2]}:
+                self._prefixes.setdefault(prefix, []).append(kid)
+            postings = self._trigrams
+            for trigram in trigrams(key):
+                posting = postings.get(trigram)
+                if posting is None:
+                    postings[trigram] = [kid]
+                else:
+                    posting.append(kid)
+        return kid
+
+    def add(self, item):
+        keys = {str(x).lower() for x in self._keys(item) if x not in (None, '')}
+        with self._lock:
+            doc = len(self._items)
+            self._items.append(item)
+            for key in keys:
+                self._key_items[self._key_id(key)].append(doc)
+
+    def extend(self, items: Iterable):
+        for item in items:
+            self.add(item)
+
+    def _match_keys(self, term: str) -> dict:
+        """Score of the keys matching a term: 2 for a prefix, 1 inside a key, below 1 approximately"""
+        if len(term) < 3:
+            return dict.fromkeys(self._prefixes.get(term, ()), 2)
+
+        postings = sorted((self._trigrams.get(x, ()) for x in trigrams(term)), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(posting)
+        scores = dict()
+        for kid in candidates:
+            text = self._key_texts[kid]
+            if text.startswith(term):
+                scores[kid] = 2
+            elif term in text:
+                scores[kid] = 1
+        if scores:
+            return scores
+
+        shared = Counter(kid for posting in postings for kid in posting)
+        return {kid: count / len(postings) for kid, count in shared.items() if count / len(postings) >= FUZZY_RATIO}
+
+    def _match(self, term: str) -> dict:
+        """Score of the items matching a term, the best of their keys"""
+        scores = dict()
+        for kid, score in self._match_keys(term).items():
+            for doc in self._key_items[kid]:
+                if scores.get(doc, 0) < score:
+                    scores[doc] = score
+        return scores
+
+    def search(self, query: str, limit: Optional[int] = None) -> list:
+        """Items matching every term of the query, best first; every item for an empty query"""
+        terms = query.lower().split()
+        with self._lock:
+            if not terms:
+                return self._items[:limit]
+            scores = None
+            for term in terms:
+                matches = self._match(term)
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {doc: score + matches[doc] for doc, score in scores.items() if doc in matches}
+                if not scores:
+                    return []
+            ranked = sorted(scores, key=lambda doc: (-scores[doc], doc))
+            return [self._items[doc] for doc in ranked[:limit]]
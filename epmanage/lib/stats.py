@@ -0,0 +1,76 @@
+"""
+stats.py : Fleet statistics
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import pandas as pd
+
+from epmanage.lib.eve_api import EveAPI
+
+AGENT_FIELDS = ('uuid', 'hostname', 'os', 'osversion', 'tags', '_updated')
+
+EVE_DATE_FORMAT = '%a, %d %b %Y %H:%M:%S GMT'
+
+# Rows converted to a DataFrame at once while loading
+CHUNK_SIZE = 10000
+
+
+def load_frame(api: EveAPI, fields: tuple, page_size: Optional[int] = None, jobs: int = 4) -> pd.DataFrame:
+    """
+    Load a collection into a DataFrame.
+    Pages are streamed and converted by chunks, so the raw documents are
+    never all kept in memory
+    """
+    projection = [x for x in fields if not x.startswith('_')]
+    frames = []
+    rows = []
+    for item in api.iter(max_results=page_size, jobs=jobs, projection=projection):
+        data = item.data
+        rows.append(tuple(data.get(x) for x in fields))
+        if len(rows) >= CHUNK_SIZE:
+            frames.append(pd.DataFrame.from_records(rows, columns=fields))
+            rows = []
+    frames.append(pd.DataFrame.from_records(rows, columns=fields))
+    frame = pd.concat(frames, ignore_index=True)
+    if '_updated' in frame:
+        frame['_updated'] = pd.to_datetime(frame['_updated'], format=EVE_DATE_FORMAT, utc=True)
+    return frame
+
+
+def by_os(agents: pd.DataFrame) -> pd.DataFrame:
+    """Number of agents per os and osversion"""
+    counts = agents.groupby(['os', 'osversion'], dropna=False).size().rename('agents').reset_index()
+    return counts.sort_values(['agents', 'os', 'osversion'], ascending=[False, True, True], ignore_index=True)
+
+
+def by_tag(agents: pd.DataFrame) -> pd.DataFrame:
+    """Number of agents per tag"""
+    tags = agents['tags'].explode().dropna()
+    tags = pd.DataFrame({'tag': tags.str.get('name'), 'type': tags.str.get('type')})
+    counts = tags.groupby(['tag', 'type'], dropna=False).size().rename('agents').reset_index()
+    return counts.sort_values(['agents', 'tag'], ascending=[False, True], ignore_index=True)
+
+
+def stale(agents: pd.DataFrame, days: int) -> pd.DataFrame:
+    """Agents not updated for the given number of days, oldest first"""
+    cutoff = pd.Timestamp(datetime.now(timezone.utc) - timedelta(days=days))
+    old = agents.loc[agents['_updated'] < cutoff, ['uuid', 'hostname', 'os', 'osversion', '_updated']]
+    return old.rename(columns={'_updated': 'updated'}).sort_values('updated', ignore_index=True)
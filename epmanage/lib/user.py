@@ -23,6 +23,8 @@ from epmanage.lib.eve_api import EveAPI, EveItem
 
 
 class User(EveItem):
+    __slots__ = ()
+
     def __init__(self, data):
         super(User, self).__init__(data)
 
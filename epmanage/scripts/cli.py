@@ -18,34 +18,86 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
+import importlib
+import sys
 from pathlib import Path
 from typing import Optional
 
-import arrow
 import click
 
-import epmanage.lib.auth
-from epmanage.lib.api import req_sess
-from epmanage.lib.user import UserAPI
-from epmanage.scripts.utils import exit_fail, echo_fail, check_privilege, convert
-from .commands.agent import agent_group
-from .commands.app import app_group
-from .commands.package import package_group
-from .commands.user import user_group
+from epmanage.scripts.utils import (exit_fail, echo_fail, echo_warning, check_privilege, convert, get_api, get_token,
+                                    setup_session)
 
+# Command groups, imported only when they are invoked
+LAZY_COMMANDS = dict(
+    agent='epmanage.scripts.commands.agent:agent_group',
+    app='epmanage.scripts.commands.app:app_group',
+    package='epmanage.scripts.commands.package:package_group',
+    user='epmanage.scripts.commands.user:user_group',
+    daemon='epmanage.scripts.commands.daemon:daemon_group',
+)
 
-@click.group()
+
+class LazyGroup(click.Group):
+    """Group loading the modules of its lazy subcommands on first use"""
+
+    def __init__(self, *args, lazy_commands: Optional[dict] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or dict()
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+            module, _, name = self.lazy_commands[cmd_name].partition(':')
+            self.add_command(getattr(importlib.import_module(module), name), name=cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+
+@click.group(cls=LazyGroup, lazy_commands=LAZY_COMMANDS)
 @click.option('--tokenfile', envvar='EPMANAGE-TOKEN', default='.token', type=click.Path(exists=False, dir_okay=False),
               help='Location of the token')
 @click.option('--baseurl', envvar='EPMANAGE-URL', help='API base url')
-def cli(tokenfile, baseurl):
-    click.get_current_context().obj = dict()
+@click.option('--cache-dir', envvar='EPMANAGE-CACHE', type=click.Path(file_okay=False),
+              help='Location of the cache')
+@click.option('--schema-ttl', envvar='EPMANAGE-SCHEMA-TTL', default=3600, type=click.IntRange(0),
+              help='Seconds before the cached schema is revalidated')
+@click.option('--inventory', envvar='EPMANAGE-INVENTORY', type=click.Path(dir_okay=False),
+              help='Location of the local inventory (see sync)')
+@click.option('--offline', is_flag=True, help='Read from the local inventory instead of the server')
+@click.option('--timeout', envvar='EPMANAGE-TIMEOUT', default=60.0, type=click.FloatRange(0, min_open=True),
+              help='Seconds to wait for the server response')
+@click.option('--connect-timeout', envvar='EPMANAGE-CONNECT-TIMEOUT', default=5.0,
+              type=click.FloatRange(0, min_open=True), help='Seconds to wait for a connection')
+@click.option('--retries', envvar='EPMANAGE-RETRIES', default=3, type=click.IntRange(0),
+              help='Number of retries of failed requests')
+@click.option('--pool-size', envvar='EPMANAGE-POOL-SIZE', default=16, type=click.IntRange(1),
+              help='Number of connections kept open per host')
+@click.option('--no-keep-alive', is_flag=True, envvar='EPMANAGE-NO-KEEP-ALIVE',
+              help='Open a new connection for every request')
+@click.option('--msgpack', is_flag=True, envvar='EPMANAGE-MSGPACK',
+              help='Ask the server for msgpack payloads (needs the msgpack module)')
+@click.option('--stats', is_flag=True, envvar='EPMANAGE-STATS', help='Print request metrics on stderr at exit')
+@click.option('--stats-format', default='text', type=click.Choice(['text', 'json']), help='Format of --stats')
+@click.option('--yes', is_flag=True, help='Answer yes to the confirmations')
+def cli(tokenfile, baseurl, cache_dir, schema_ttl, inventory, offline, timeout, connect_timeout, retries, pool_size,
+        no_keep_alive, msgpack, stats, stats_format, yes):
+    click.get_current_context().obj = dict(yes=yes)
     tokenfile = Path(tokenfile)
     if tokenfile.exists():
         click.get_current_context().obj['raw_token'] = tokenfile.read_text()
-        click.get_current_context().obj['token'] = epmanage.lib.auth.check_token(
-            click.get_current_context().obj['raw_token'])
-    req_sess.base_url = baseurl
+    # Applied by setup_session() when a command needs the server
+    click.get_current_context().obj['options'] = dict(
+        baseurl=baseurl,
+        cache_dir=cache_dir,
+        schema_ttl=schema_ttl,
+        inventory=inventory,
+        offline=offline,
+        msgpack=msgpack,
+        stats=stats_format if stats else None,
+        transport=dict(connect_timeout=connect_timeout, read_timeout=timeout, retries=retries, pool_size=pool_size,
+                       keep_alive=not no_keep_alive))
 
 
 @cli.command()
@@ -60,6 +112,10 @@ def version():
 @click.option('--mfa', help='MFA token')
 @click.argument('tokenfile', envvar='EPMANAGE-TOKEN', default='.token', type=click.File('w'))
 def auth(email: str, password: str, mfa: Optional[str], tokenfile):
+    import arrow
+    import epmanage.lib.auth
+
+    setup_session()
     status, rsp = epmanage.lib.auth.auth(email, password)
     if not status:
         exit_fail(rsp)
@@ -96,7 +152,10 @@ def auth(email: str, password: str, mfa: Optional[str], tokenfile):
 
 @cli.command()
 def check_token():
-    token = click.get_current_context().obj['token']
+    import arrow
+    import epmanage.lib.auth
+
+    token = get_token()
     if not token:
         exit_fail('Invalid token')
     click.secho('Valid token', fg='green')
@@ -110,9 +169,11 @@ def check_token():
 @click.argument('param', required=False)
 @click.argument('value', required=False)
 def profile(param, value):
-    token = click.get_current_context().obj['token']
+    from epmanage.lib.user import UserAPI
+
+    token = get_token()
     user_id = token['sub']
-    user_api = UserAPI()
+    user_api = get_api(UserAPI)
     user, error = user_api.get(user_id)
     if not user:
         exit_fail('Cannot get profile, {}'.format(error))
@@ -127,7 +188,7 @@ def profile(param, value):
 
         prop_type = user.get_prop_type(param).get('type')
         value, error = convert(prop_type, value)
-        if not value:
+        if error:
             exit_fail('Invalid value: {}'.format(error))
 
         ret, error = user_api.patch(user, {param: value})
@@ -142,10 +203,207 @@ def profile(param, value):
             click.echo(' = {}'.format(value))
 
 
-cli.add_command(agent_group, name='agent')
-cli.add_command(app_group, name='app')
-cli.add_command(package_group, name='package')
-cli.add_command(user_group, name='user')
+@cli.command()
+@check_privilege('ro')
+@click.option('--model', 'models', multiple=True, type=click.Choice(['agent', 'user', 'app']),
+              help='Model to synchronize (default: all)')
+@click.option('--full', is_flag=True, help='Reload everything instead of only the changes')
+@click.option('--jobs', default=4, type=click.IntRange(1), help='Number of pages fetched in parallel')
+@click.option('--stream', is_flag=True, help='Decode the pages while they are received, one at a time (less memory)')
+def sync(models, full, jobs, stream):
+    import epmanage.lib.auth
+    from epmanage.lib.agent import AgentAPI
+    from epmanage.lib.app import AppAPI
+    from epmanage.lib.inventory import Inventory
+    from epmanage.lib.schema import schema_registry
+    from epmanage.lib.user import UserAPI
+
+    obj = click.get_current_context().obj
+    if obj.get('inventory'):
+        exit_fail('Cannot synchronize in offline mode')
+    inventory = Inventory(obj['inventory_path'])
+    # Keep the schema in the cache, it is needed offline
+    schema_registry.load()
+
+    privileges = epmanage.lib.auth.get_privileges(obj['token'])
+    for api in (AgentAPI(), UserAPI(), AppAPI()):
+        if models and api.model not in models:
+            continue
+        if api.model == 'user' and 'admin' not in privileges:
+            echo_warning('Insufficient permissions to synchronize users')
+            continue
+        updated, deleted = inventory.sync(api, jobs, full, stream=stream)
+        click.secho('{} '.format(api.model), nl=False, fg='green')
+        click.echo('{} updated, {} deleted'.format(updated, deleted))
+    inventory.close()
+
+
+@cli.command()
+def shell():
+    """Run commands interactively over a single session"""
+    import shlex
+    from epmanage.lib.cache import default_cache_dir
+    from epmanage.scripts.utils.runner import global_args, run_command
+
+    try:
+        import readline
+    except ImportError:
+        readline = None
+    history = default_cache_dir() / 'shell_history'
+    if readline:
+        try:
+            readline.read_history_file(str(history))
+        except OSError:
+            pass
+
+    prefix = global_args()
+    click.echo('Type a command without "epmanage-cli" (e.g. agent list), "exit" to quit')
+    while True:
+        try:
+            line = input('epmanage> ')
+        except EOFError:
+            click.echo()
+            break
+        except KeyboardInterrupt:
+            click.echo()
+            continue
+        try:
+            args = shlex.split(line)
+        except ValueError as exc:
+            echo_fail(exc)
+            continue
+        if not args:
+            continue
+        elif args[0] in ('exit', 'quit'):
+            break
+        elif args[0] == 'shell':
+            echo_warning('Already in the shell')
+            continue
+        try:
+            run_command(prefix + args)
+        except KeyboardInterrupt:
+            click.echo()
+
+    if readline:
+        try:
+            history.parent.mkdir(parents=True, exist_ok=True)
+            readline.write_history_file(str(history))
+        except OSError:
+            pass
+
+
+def run_line(prefix: list, number: int, line: str) -> dict:
+    """Run a line of a batch, capturing its output"""
+    import shlex
+    import time
+    from epmanage.scripts.utils.runner import Capture, run_command
+
+    result = dict(line=number, command=line, status=2, stdout='', stderr='', elapsed=0.0)
+    try:
+        args = shlex.split(line)
+    except ValueError as exc:
+        result['stderr'] = 'Invalid line: {}\n'.format(exc)
+        return result
+    if args[0] in ('batch', 'shell', 'daemon', 'auth'):
+        result['stderr'] = '{} cannot be used in a batch\n'.format(args[0])
+        return result
+
+    stdout, stderr = Capture(), Capture()
+    start = time.perf_counter()
+    result['status'] = run_command(prefix + args, stdout=stdout, stderr=stderr, stdin=Capture())
+    result['elapsed'] = time.perf_counter() - start
+    result['stdout'] = stdout.getvalue()
+    result['stderr'] = stderr.getvalue()
+    return result
+
+
+@cli.command()
+@click.argument('script', type=click.File('r'))
+@click.option('--jobs', default=1, type=click.IntRange(1), help='Number of lines run concurrently')
+@click.option('--stop-on-error', is_flag=True, help='Do not start other lines after a failure')
+@click.option('--yes', is_flag=True, help='Answer yes to the confirmations')
+@click.option('--format', 'fmt', default='text', type=click.Choice(['text', 'ndjson']), help='Report format')
+def batch(script, jobs, stop_on_error, yes, fmt):
+    """
+    Run the commands of SCRIPT (- for stdin) over a single session, one per line.
+    Blank lines and lines starting with # are ignored. With --jobs, lines must not depend on each other
+    """
+    import json
+    import time
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    from epmanage.scripts.utils.runner import global_args
+
+    prefix = global_args()
+    if yes and '--yes' not in prefix:
+        prefix.append('--yes')
+    lines = ((i, x.strip()) for i, x in enumerate(script, 1))
+    lines = ((i, x) for i, x in lines if x and not x.startswith('#'))
+
+    start = time.perf_counter()
+    failures = []
+    skipped = 0
+    count = 0
+    # Results are reported in the order of the script. At most 2*jobs lines are in flight,
+    # jobs with --stop-on-error so that no line is queued behind a failure
+    in_flight = jobs if stop_on_error else jobs * 2
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        stopped = False
+        while True:
+            while not stopped and len(pending) < in_flight:
+                line = next(lines, None)
+                if line is None:
+                    stopped = True
+                    break
+                pending.append((line, executor.submit(run_line, prefix, line[0], line[1])))
+            if not pending:
+                break
+            line, future = pending.popleft()
+            if future.cancelled():
+                skipped += 1
+                result = dict(line=line[0], command=line[1], status=None, skipped=True)
+                if fmt == 'ndjson':
+                    click.echo(json.dumps(result))
+                else:
+                    click.secho('[{line}] '.format(**result), nl=False, fg='yellow')
+                    click.echo('{command} '.format(**result), nl=False)
+                    click.secho('skipped', fg='yellow')
+                continue
+
+            result = future.result()
+            count += 1
+            if result['status']:
+                failures.append(result)
+                if stop_on_error and not stopped:
+                    stopped = True
+                    for _, other in pending:
+                        other.cancel()
+
+            if fmt == 'ndjson':
+                click.echo(json.dumps(result))
+                continue
+            click.secho('[{line}] '.format(**result), nl=False, fg='yellow')
+            click.echo('{command} '.format(**result), nl=False)
+            if result['status']:
+                click.secho('failed ({status})'.format(**result), fg='red')
+            else:
+                click.secho('ok', fg='green', nl=False)
+                click.echo(' ({:.2f}s)'.format(result['elapsed']))
+            click.echo(result['stdout'], nl=False)
+            click.echo(result['stderr'], nl=False, err=True)
+
+    elapsed = time.perf_counter() - start
+    if fmt == 'text':
+        click.echo('{} command(s) in {:.2f}s: {} succeeded, {} failed{}'.format(
+            count, elapsed, count - len(failures), len(failures),
+            ', {} skipped'.format(skipped) if skipped else ''))
+        for result in failures:
+            click.secho('  line {line}: '.format(**result), nl=False, fg='red')
+            click.echo(result['command'])
+    if failures:
+        sys.exit(1)
+
 
 if __name__ == '__main__':
     cli()
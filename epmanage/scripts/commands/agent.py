@@ -18,13 +18,22 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
 from typing import Optional
 
 import click
 
 from epmanage.lib.agent import Agent
 from epmanage.lib.agent import AgentAPI
-from epmanage.scripts.utils import check_privilege, exit_warning, exit_fail, convert
+from epmanage.lib.eve_api import eve_date, parse_eve_date, is_precondition_failed
+from epmanage.lib.search import SearchIndex
+from epmanage.scripts.utils import (check_privilege, exit_warning, exit_fail, convert, confirm, Duration, projection,
+                                    get_api)
+from epmanage.scripts.utils.render import Renderer, output_options
+from epmanage.scripts.utils.picker import pick
 
 
 @click.group()
@@ -32,82 +41,190 @@ def agent_group():
     pass
 
 
-def print_tags(tags: Optional[list]):
-    if tags:
-        for tag in tags:
-            click.echo('[', nl=False)
-            click.secho('{name}'.format(**tag), fg='green' if tag.get('type') == 'system' else 'white', nl=False)
-            click.echo('] ', nl=False)
+def format_tags(tags: Optional[list], style=click.style) -> str:
+    out = []
+    for tag in tags or []:
+        out.append('[{}] '.format(
+            style('{name}'.format_map(tag), fg='green' if tag.get('type') == 'system' else 'white')))
+    return ''.join(out)
+
+
+@projection('uuid', 'hostname', 'os', 'osversion', 'tags')
+def format_agent(attrs: dict, style=click.style) -> str:
+    return '{}{} {}'.format(
+        style('{uuid} '.format_map(attrs), fg='yellow'),
+        '{hostname} ({os} {osversion})'.format_map(attrs),
+        format_tags(attrs.get('tags'), style))
+
+
+def agent_keys(agent: Agent) -> list:
+    """Searched fields of an agent"""
+    data = agent.data
+    keys = [data.get('hostname'), data.get('uuid'), data.get('os'), data.get('osversion')]
+    return keys + [x.get('name') for x in data.get('tags') or []]
 
 
 def print_agent(agent: Agent, expand=False):
-    attrs = agent.attributes()
     if not expand:
-        click.secho('{uuid} '.format(**attrs), nl=False, fg='yellow')
-        click.echo('{hostname} ({os} {osversion}) '.format(**attrs), nl=False)
-        print_tags(attrs.get('tags'))
+        click.echo(format_agent(agent), nl=False)
     else:
-        for name, value in attrs.items():
+        for name in agent:
             click.secho('{}'.format(name), nl=False)
-            click.echo(' = {}'.format(value))
+            click.echo(' = {}'.format(agent[name]))
 
 
 @agent_group.command()
 @check_privilege('ro')
-def list():
-    data = AgentAPI().list()  # type: list[Agent]
-    if not data:
+@click.option('--page-size', type=click.IntRange(1), help='Number of agents fetched per request')
+@click.option('--jobs', default=4, type=click.IntRange(1), help='Number of pages fetched in parallel')
+@click.option('--stream', is_flag=True, help='Decode the pages while they are received, one at a time (less memory)')
+@output_options
+def list(page_size, jobs, stream, fmt, no_color):
+    agents = get_api(AgentAPI).iter(max_results=page_size, jobs=jobs, projection=format_agent.projection,
+                                    stream=stream)
+    with Renderer(fmt, format_agent, format_agent.projection, color=not no_color) as renderer:
+        for agent in agents:
+            renderer.row(agent)
+    if not renderer.count:
         exit_warning('No data')
-    for i, agent in enumerate(data):
-        click.echo('[{}] '.format(i), nl=False)
-        print_agent(agent)
-        click.echo()
+
+
+@agent_group.command()
+@check_privilege('ro')
+@click.argument('text', nargs=-1, required=True)
+@click.option('--limit', default=20, show_default=True, type=click.IntRange(0),
+              help='Maximum number of agents shown (0: no limit)')
+@click.option('--page-size', type=click.IntRange(1), help='Number of agents fetched per request')
+@click.option('--jobs', default=4, type=click.IntRange(1), help='Number of pages fetched in parallel')
+@output_options
+def find(text, limit, page_size, jobs, fmt, no_color):
+    """Search agents by hostname, UUID, OS or tag, best matches first"""
+    agents = get_api(AgentAPI).iter(max_results=page_size, jobs=jobs, projection=format_agent.projection)
+    index = SearchIndex(agent_keys)
+    index.extend(agents)
+    with Renderer(fmt, format_agent, format_agent.projection, color=not no_color) as renderer:
+        for agent in index.search(' '.join(text), limit or None):
+            renderer.row(agent)
+    if not renderer.count:
+        exit_warning('No agent matches')
 
 
 @agent_group.command()
 @check_privilege('ro')
 @click.argument('uuid', required=False)
-def print(uuid):
-    agent_api = AgentAPI()
+@click.option('--jobs', default=4, type=click.IntRange(1), help='Number of pages fetched in parallel')
+def print(uuid, jobs):
+    agent_api = get_api(AgentAPI)
     if not uuid:
-        data = agent_api.list()  # type: list[Agent]
-        if not data:
+        # The local inventory can only be read from this thread
+        offline = click.get_current_context().obj.get('inventory') is not None
+        agent = pick(agent_api.iter(jobs=jobs), agent_keys, format_agent, 'Select an agent', background=not offline)
+        if agent is None:
             exit_warning('No data')
-        uuids = dict()
-        for i, agent in enumerate(data):
-            click.echo('[{}] '.format(i), nl=False)
-            print_agent(agent)
-            click.echo()
-            uuids[i] = agent.attributes()['uuid']
-        uuid = uuids[click.prompt('Select an agent', type=click.IntRange(0, len(data)))]
-
-    agent, error = agent_api.get(uuid)
-    if not agent:
-        exit_fail('Agent not found')
+    else:
+        agent, error = agent_api.get(uuid)
+        if not agent:
+            exit_fail('Agent not found')
 
     print_agent(agent, expand=True)
 
 
+@agent_group.command()
+@check_privilege('ro')
+@click.option('--where', help='Only watch the agents matching this Eve query')
+@click.option('--field', 'fields', multiple=True, help='Field included in the events (default: every field)')
+@click.option('--initial', is_flag=True, help='Start with an added event for every existing agent')
+@click.option('--interval', default=2.0, show_default=True, type=click.FloatRange(0.1),
+              help='Seconds between polls while agents change')
+@click.option('--max-interval', default=60.0, show_default=True, type=click.FloatRange(0.1),
+              help='Longest wait between polls when nothing changes')
+@click.option('--scan-interval', default=300.0, show_default=True, type=click.FloatRange(0),
+              help='Seconds between the listings detecting removed agents (0: never)')
+@click.option('--page-size', type=click.IntRange(1), help='Number of agents fetched per request')
+@click.option('--jobs', default=4, type=click.IntRange(1), help='Number of pages fetched in parallel')
+def watch(where, fields, initial, interval, max_interval, scan_interval, page_size, jobs):
+    """Print added, changed and removed agents as NDJSON events, until interrupted"""
+    from epmanage.lib.codec import codec
+
+    agent_api = get_api(AgentAPI)
+    try:
+        events = agent_api.watch(where, fields or None, interval, max(interval, max_interval), scan_interval,
+                                 initial, page_size, jobs)
+        for event in events:
+            line = dict(event=event.event, time=eve_date(datetime.now(timezone.utc)))
+            if event.id:
+                line['id'] = event.id
+            if event.item is not None:
+                line['agent'] = event.item.data
+            if event.message:
+                line['message'] = event.message
+            click.echo(codec.dumps(line))
+    except ValueError as exc:
+        exit_fail(str(exc))
+
+
+def set_many(where: str, param: str, value: str, jobs: int):
+    agent_api = get_api(AgentAPI)
+    prop = agent_api.schema.get(param)
+    if prop is None:
+        exit_fail('Invalid parameter')
+    elif prop.get('readonly'):
+        exit_fail('The specified parameter is read-only')
+
+    value, error = convert(prop.get('type'), value)
+    if error:
+        exit_fail('Invalid value: {}'.format(error))
+
+    success = 0
+    failures = []
+    try:
+        agents = agent_api.iter(where=where, projection=('uuid',))
+    except ValueError as exc:
+        exit_fail(str(exc))
+    for agent, error in agent_api.patch_many(agents, {param: value}, jobs=jobs):
+        if error:
+            failures.append((agent, error))
+        else:
+            success += 1
+
+    if not success and not failures:
+        exit_warning('No agent matches')
+    for agent, error in failures:
+        click.secho('{} '.format(agent['uuid']), nl=False, fg='yellow')
+        click.echo(error.get('_error', {}).get('message', error))
+    click.secho('Updated {} agent(s)'.format(success), fg='green')
+    if failures:
+        exit_fail('{} update(s) failed'.format(len(failures)))
+
+
 @agent_group.command()
 @check_privilege('rw')
-@click.argument('uuid')
-@click.argument('param')
-@click.argument('value')
-def set(uuid, param, value):
-    agent_api = AgentAPI()
-    agent = agent_api.get(uuid)  # type: Agent
+@click.option('--where', help='Update every agent matching this Eve query instead of a single UUID')
+@click.option('--jobs', default=8, type=click.IntRange(1), help='Number of parallel updates with --where')
+@click.argument('args', nargs=-1, required=True, metavar='[UUID] PARAM VALUE')
+def set(where, jobs, args):
+    if where:
+        if len(args) != 2:
+            raise click.UsageError('Expected PARAM VALUE with --where')
+        set_many(where, args[0], args[1], jobs)
+        return
+
+    if len(args) != 3:
+        raise click.UsageError('Expected UUID PARAM VALUE')
+    uuid, param, value = args
+    agent_api = get_api(AgentAPI)
+    agent, error = agent_api.get(uuid)  # type: Agent
     if not agent:
         exit_fail('Agent not found')
-    attrs = agent.attributes()
 
-    if not param in attrs:
+    if param not in agent:
         exit_fail('Invalid parameter')
     elif agent.is_prop_read_only(param):
         exit_fail('The specified parameter is read-only')
 
     prop_type = agent.get_prop_type(param).get('type')
     value, error = convert(prop_type, value)
-    if not value:
+    if error:
         exit_fail('Invalid value: {}'.format(error))
 
     ret, error = agent_api.patch(agent, {param: value})
@@ -121,14 +238,155 @@ def set(uuid, param, value):
 @check_privilege('rw')
 @click.argument('uuid')
 def delete(uuid):
-    agent_api = AgentAPI()
-    agent = agent_api.get(uuid)
+    agent_api = get_api(AgentAPI)
+    agent, error = agent_api.get(uuid)
     if not agent:
         exit_fail('Agent not found')
 
-    if click.confirm('Do you really want to delete this agent?'):
+    if confirm('Do you really want to delete this agent?'):
         ret, error = agent_api.delete(agent)
         if ret:
             click.secho('Agent deleted', fg='green')
         else:
             click.secho('Deletion error', fg='red')
+
+
+def load_checkpoint(path: Path) -> Optional[dict]:
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        exit_fail('Invalid checkpoint {}: {}'.format(path, exc))
+
+
+def save_checkpoint(path: Path, state: dict):
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_text(json.dumps(state))
+    os.replace(str(tmp), str(path))
+
+
+@agent_group.command()
+@check_privilege('rw')
+@click.option('--older-than', required=True, type=Duration(), help='Minimum age of the last update, e.g. 30d')
+@click.option('--field', default='_updated', show_default=True, help='Date field holding the last update')
+@click.option('--jobs', default=8, type=click.IntRange(1), help='Number of parallel deletions')
+@click.option('--checkpoint', default='.prune-checkpoint', show_default=True, type=click.Path(dir_okay=False),
+              help='Progress file, used to resume an interrupted prune')
+def prune(older_than, field, jobs, checkpoint):
+    agent_api = get_api(AgentAPI)
+    checkpoint = Path(checkpoint)
+    state = load_checkpoint(checkpoint)
+    if state:
+        if state['field'] != field or state.get('older_than', older_than.total_seconds()) != older_than.total_seconds():
+            exit_fail('{} prunes agents with {} before {}: run with the same --field and --older-than, '
+                      'or delete it'.format(checkpoint, state['field'], state['cutoff']))
+        # Keep the original cutoff so the candidates do not change between runs
+        click.echo('Resuming from {} ({} agent(s) already deleted)'.format(checkpoint, len(state['done'])))
+    else:
+        state = dict(field=field, older_than=older_than.total_seconds(),
+                     cutoff=eve_date(datetime.now(timezone.utc) - older_than), done=[])
+
+    done = frozenset(state['done'])
+    try:
+        candidates = agent_api.iter(where={state['field']: {'$lt': state['cutoff']}}, jobs=jobs, projection=('uuid',))
+    except ValueError as exc:
+        exit_fail(str(exc))
+    candidates = [x for x in candidates if x.id not in done]
+    if not candidates:
+        if checkpoint.exists():
+            checkpoint.unlink()
+        exit_warning('No agent last updated before {}'.format(state['cutoff']))
+
+    if not confirm('Do you really want to delete {} agent(s) last updated before {}?'.format(
+            len(candidates), state['cutoff'])):
+        return
+
+    cutoff = parse_eve_date(state['cutoff'])
+
+    def still_stale(agent):
+        # An agent changed since it was listed is only deleted if it still qualifies
+        value = agent[state['field']]
+        return bool(value) and parse_eve_date(value) < cutoff
+
+    failures = []
+    skipped = 0
+    save_checkpoint(checkpoint, state)
+    try:
+        for i, (agent, error) in enumerate(agent_api.delete_many(candidates, jobs=jobs, check=still_stale)):
+            if is_precondition_failed(error) and not still_stale(agent):
+                skipped += 1
+            elif is_precondition_failed(error):
+                # Still stale, but it changed again on every attempt
+                failures.append((agent, dict(_error=dict(message='Changed during every attempt'))))
+            elif error:
+                failures.append((agent, error))
+            else:
+                state['done'].append(agent.id)
+            if i % 100 == 99:
+                save_checkpoint(checkpoint, state)
+    finally:
+        save_checkpoint(checkpoint, state)
+
+    for agent, error in failures:
+        click.secho('{} '.format(agent['uuid']), nl=False, fg='yellow')
+        click.echo(error.get('_error', {}).get('message', error))
+    click.secho('Deleted {} agent(s)'.format(len(candidates) - len(failures) - skipped), fg='green')
+    if skipped:
+        click.secho('Skipped {} agent(s) updated since they were listed'.format(skipped), fg='yellow')
+    if failures:
+        exit_fail('{} deletion(s) failed, run again to retry'.format(len(failures)))
+    checkpoint.unlink()
+
+
+@agent_group.command()
+@check_privilege('ro')
+@click.option('--report', 'reports', multiple=True, type=click.Choice(['os', 'tags', 'stale']),
+              help='Report to compute (default: all, table format only)')
+@click.option('--stale-days', default=30, show_default=True, type=click.IntRange(0),
+              help='Number of days without update after which an agent is stale')
+@click.option('--format', 'fmt', default='table', type=click.Choice(['table', 'csv', 'parquet']))
+@click.option('--output', type=click.Path(dir_okay=False), help='Output file (default: stdout)')
+@click.option('--page-size', type=click.IntRange(1), help='Number of agents fetched per request')
+@click.option('--jobs', default=4, type=click.IntRange(1), help='Number of pages fetched in parallel')
+def stats(reports, stale_days, fmt, output, page_size, jobs):
+    import epmanage.lib.stats
+
+    reports = reports or ('os', 'tags', 'stale')
+    if fmt != 'table' and len(reports) != 1:
+        raise click.UsageError('Exactly one --report is needed with --format {}'.format(fmt))
+    if fmt == 'parquet' and not output:
+        raise click.UsageError('--output is needed with --format parquet')
+
+    agents = epmanage.lib.stats.load_frame(
+        get_api(AgentAPI), epmanage.lib.stats.AGENT_FIELDS, page_size=page_size, jobs=jobs)
+    if agents.empty:
+        exit_warning('No data')
+
+    titles = dict(os='Agents by OS', tags='Agents by tag', stale='Agents not updated for {} days'.format(stale_days))
+    frames = dict(
+        os=lambda: epmanage.lib.stats.by_os(agents),
+        tags=lambda: epmanage.lib.stats.by_tag(agents),
+        stale=lambda: epmanage.lib.stats.stale(agents, stale_days))
+
+    if fmt == 'csv':
+        data = frames[reports[0]]().to_csv(output, index=False)
+        if data is not None:
+            click.echo(data, nl=False)
+    elif fmt == 'parquet':
+        try:
+            frames[reports[0]]().to_parquet(output, index=False)
+        except ImportError as exc:
+            exit_fail('Parquet output needs pyarrow or fastparquet: {}'.format(exc))
+    else:
+        lines = []
+        for report in reports:
+            frame = frames[report]()
+            lines.append('{} ({})'.format(titles[report], len(frame)))
+            lines.append(frame.to_string(index=False) if not frame.empty else '  -')
+            lines.append('')
+        if output:
+            with open(output, 'w') as ofile:
+                ofile.write('\n'.join(lines))
+        else:
+            click.echo('\n'.join(lines))
@@ -23,7 +23,8 @@ from typing import List
 import click
 
 from epmanage.lib.app import AppAPI, App
-from epmanage.scripts.utils import check_privilege, exit_warning, exit_fail
+from epmanage.scripts.utils import check_privilege, exit_warning, exit_fail, projection, get_api
+from epmanage.scripts.utils.render import Renderer, output_options
 
 
 @click.group()
@@ -31,33 +32,39 @@ def app_group():
     pass
 
 
+@projection('name')
+def format_app(attrs: dict, style=click.style) -> str:
+    return style('{name} '.format_map(attrs), fg='yellow')
+
+
 def print_app(app: App, expand=False):
-    attrs = app.attributes()
     if not expand:
-        click.secho('{name} '.format(**attrs), nl=False, fg='yellow')
+        click.echo(format_app(app), nl=False)
     else:
-        for name, value in attrs.items():
+        for name in app:
             click.secho('{}'.format(name), nl=False)
-            click.echo(' = {}'.format(value))
+            click.echo(' = {}'.format(app[name]))
 
 
 @app_group.command()
 @check_privilege('ro')
-def list():
-    data = AppAPI().list()  # type: List[App]
-    if not data:
+@click.option('--page-size', type=click.IntRange(1), help='Number of apps fetched per request')
+@click.option('--jobs', default=4, type=click.IntRange(1), help='Number of pages fetched in parallel')
+@output_options
+def list(page_size, jobs, fmt, no_color):
+    apps = get_api(AppAPI).iter(max_results=page_size, jobs=jobs, projection=format_app.projection)
+    with Renderer(fmt, format_app, format_app.projection, color=not no_color) as renderer:
+        for app in apps:
+            renderer.row(app)
+    if not renderer.count:
         exit_warning('No data')
-    for i, app in enumerate(data):
-        click.echo('[{}] '.format(i), nl=False)
-        print_app(app)
-        click.echo()
 
 
 @app_group.command()
 @check_privilege('superadmin')
 def adminlist():
-    app_api = AppAPI()
-    data = app_api.list()  # type: List[App]
+    app_api = get_api(AppAPI)
+    data = app_api.list(projection=format_app.projection)  # type: List[App]
     if not data:
         exit_warning('No data')
     apps = {x['name']: x for x in data}
@@ -0,0 +1,103 @@
+"""
+daemon.py : Daemon management
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import click
+
+from epmanage.scripts.daemon import Daemon, connect, control, socket_path
+from epmanage.scripts.utils import exit_fail, exit_warning
+
+
+@click.group()
+@click.option('--socket', 'socket_file', envvar='EPMANAGE-SOCKET', type=click.Path(dir_okay=False),
+              help='Location of the daemon socket')
+def daemon_group(socket_file):
+    """Keep a session open in the background; the other commands go through it"""
+    click.get_current_context().obj['socket'] = Path(socket_file) if socket_file else socket_path()
+
+
+@daemon_group.command()
+@click.option('--idle', default=3600, show_default=True, type=click.IntRange(0),
+              help='Seconds without command after which the daemon exits (0: never)')
+@click.option('--schema-refresh', default=300, show_default=True, type=click.IntRange(0),
+              help='Seconds the schema is kept in memory between commands')
+def run(idle, schema_refresh):
+    """Run the daemon in the foreground"""
+    try:
+        Daemon(click.get_current_context().obj['socket'], idle, schema_refresh).serve()
+    except (OSError, RuntimeError) as exc:
+        exit_fail(exc)
+
+
+@daemon_group.command()
+@click.option('--idle', default=3600, show_default=True, type=click.IntRange(0),
+              help='Seconds without command after which the daemon exits (0: never)')
+@click.option('--schema-refresh', default=300, show_default=True, type=click.IntRange(0),
+              help='Seconds the schema is kept in memory between commands')
+def start(idle, schema_refresh):
+    """Start the daemon in the background"""
+    path = click.get_current_context().obj['socket']
+    if connect(path) is not None:
+        exit_warning('Already running on {}'.format(path))
+
+    env = dict(os.environ, **{'EPMANAGE-SOCKET': str(path)})
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen(
+            [sys.executable, '-m', 'epmanage.scripts.cli', 'daemon', 'run', '--idle', str(idle),
+             '--schema-refresh', str(schema_refresh)],
+            stdin=devnull, stdout=devnull, stderr=devnull, env=env, start_new_session=True)
+    for _ in range(50):
+        sock = connect(path)
+        if sock is not None:
+            sock.close()
+            click.secho('Daemon listening on {}'.format(path), fg='green')
+            return
+        time.sleep(0.1)
+    exit_fail('The daemon did not start')
+
+
+@daemon_group.command()
+def stop():
+    """Stop the daemon"""
+    path = click.get_current_context().obj['socket']
+    if control('stop', path) is None:
+        exit_warning('Not running')
+    click.secho('Daemon stopped', fg='green')
+
+
+@daemon_group.command()
+def status():
+    """Show the state of the daemon"""
+    path = click.get_current_context().obj['socket']
+    data = control('status', path)
+    if data is None:
+        exit_warning('Not running')
+    data = json.loads(data)
+    click.secho('Running ', nl=False, fg='green')
+    click.echo('on {} (pid {}, up {}s)'.format(path, data['pid'], data['uptime']))
+    click.echo('  commands: {}'.format(data['commands']))
+    for name, value in data['transport'].items():
+        click.echo('  {}: {}'.format(name, value))
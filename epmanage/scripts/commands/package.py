@@ -18,17 +18,25 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
+from pathlib import Path
 
 import arrow
 import click
 
+from epmanage.lib.api import CommException
 from epmanage.lib.package import PackageAPI
 from epmanage.scripts.utils import check_privilege, exit_warning, exit_fail
 
 
 @click.group()
-def package_group():
-    pass
+@click.option('--catalog-ttl', envvar='EPMANAGE-CATALOG-TTL', default=0, type=click.IntRange(0),
+              help='Seconds during which the cached catalog is used without revalidation')
+def package_group(catalog_ttl):
+    click.get_current_context().obj['catalog_ttl'] = catalog_ttl
+
+
+def get_package_api() -> PackageAPI:
+    return PackageAPI(click.get_current_context().obj.get('catalog_ttl', 0))
 
 
 def print_pkg(pkg: dict):
@@ -42,7 +50,7 @@ def print_pkg(pkg: dict):
 @package_group.command()
 @check_privilege('ro')
 def list():
-    items = PackageAPI().list()
+    items = get_package_api().list()
     if not items:
         exit_warning('No data')
 
@@ -58,9 +66,11 @@ def list():
 @package_group.command()
 @check_privilege('ro')
 @click.argument('os')
-@click.option('--osversion', help='OS version')
+@click.option('--osversion', help='OS version, or "latest"')
 @click.option('--arch', help='Architecture')
-def download(os, osversion, arch):
+@click.option('--directory', default='.', type=click.Path(file_okay=False, exists=True),
+              help='Destination directory')
+def download(os, osversion, arch, directory):
     def choose_callback(pkgs):
         for i in range(len(pkgs)):
             click.echo('[{}] '.format(i), nl=False)
@@ -68,13 +78,62 @@ def download(os, osversion, arch):
         return click.prompt('Select a package', type=click.IntRange(0, len(pkgs)))
 
     try:
-        fname, content = PackageAPI().download(os, osversion, arch, choose_callback)
+        pkg_file = get_package_api().download(os, osversion, arch, choose_callback, Path(directory))
     except ValueError as exc:
         exit_fail(exc)
+    except CommException as exc:
+        exit_fail('Download interrupted, run again to resume: {}'.format(exc))
+    except OSError as exc:
+        exit_fail('Cannot save file to disk: {}'.format(exc))
+
+    click.secho('Download successful : {}'.format(pkg_file.path), fg='green')
+    click.echo('  sha256: {}'.format(pkg_file.sha256))
 
+
+@package_group.command()
+@check_privilege('ro')
+@click.argument('os')
+@click.option('--osversion', help='OS version, or "latest"')
+@click.option('--arch', help='Architecture')
+def resolve(os, osversion, arch):
     try:
-        with open(fname, 'wb') as ofile:
-            ofile.write(content)
-        click.secho('Download successful : {}'.format(fname), fg='green')
+        pkgs = get_package_api().catalog().find(os, osversion, arch)
+    except ValueError as exc:
+        exit_fail(exc)
+    if not pkgs:
+        exit_warning('No package found')
+    for pkg in pkgs:
+        click.echo('{}\t'.format(pkg.get('url')), nl=False)
+        print_pkg(pkg)
+
+
+@package_group.command()
+@check_privilege('ro')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--jobs', default=4, type=click.IntRange(1), help='Number of parallel downloads')
+@click.option('--verify', is_flag=True, help='Check the hash of the packages already mirrored')
+@click.option('--delete', is_flag=True, help='Delete packages removed from the catalog')
+def mirror(directory, jobs, verify, delete):
+    directory = Path(directory)
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
     except OSError as exc:
-        exit_fail('Cannot save file to disk: {}'.format(exc))
+        exit_fail('Cannot create {}: {}'.format(directory, exc))
+
+    stats = dict()
+    for pkg, status in get_package_api().mirror(directory, jobs, verify, delete):
+        status, _, reason = status.partition(': ')
+        stats[status] = stats.get(status, 0) + 1
+        if status == 'unchanged':
+            continue
+        click.secho('{:<10} '.format(status), nl=False, fg='red' if reason else 'green')
+        click.echo('{} '.format(pkg.get('os')), nl=False)
+        print_pkg(pkg)
+        if reason:
+            click.echo('  {}'.format(reason))
+
+    if not stats:
+        exit_warning('No data')
+    click.echo(', '.join('{} {}'.format(count, status) for status, count in sorted(stats.items())))
+    if stats.get('failed'):
+        exit_fail('{} package(s) could not be mirrored'.format(stats['failed']))
@@ -18,13 +18,14 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
-from typing import List
 
 import click
 
 from epmanage.lib.user import User
 from epmanage.lib.user import UserAPI
-from epmanage.scripts.utils import check_privilege, exit_warning, exit_fail, convert
+from epmanage.scripts.utils import check_privilege, exit_warning, exit_fail, convert, confirm, projection, get_api
+from epmanage.scripts.utils.render import Renderer, output_options
+from epmanage.scripts.utils.picker import pick
 
 
 @click.group()
@@ -32,48 +33,56 @@ def user_group():
     pass
 
 
+@projection('email')
+def format_user(attrs: dict, style=click.style) -> str:
+    return style('{email} '.format_map(attrs), fg='yellow')
+
+
+def user_keys(user: User) -> list:
+    """Searched fields of a user"""
+    data = user.data
+    return [data.get('email'), data.get('firstname'), data.get('lastname')]
+
+
 def print_user(user: User, expand=False):
-    attrs = user.attributes()
     if not expand:
-        click.secho('{email} '.format(**attrs), nl=False, fg='yellow')
+        click.echo(format_user(user), nl=False)
     else:
-        for name, value in attrs.items():
+        for name in user:
             click.secho('{}'.format(name), nl=False)
-            click.echo(' = {}'.format(value))
+            click.echo(' = {}'.format(user[name]))
 
 
 @user_group.command()
 @check_privilege('admin')
-def list():
-    data = UserAPI().list()  # type: List[User]
-    if not data:
+@click.option('--page-size', type=click.IntRange(1), help='Number of users fetched per request')
+@click.option('--jobs', default=4, type=click.IntRange(1), help='Number of pages fetched in parallel')
+@output_options
+def list(page_size, jobs, fmt, no_color):
+    users = get_api(UserAPI).iter(max_results=page_size, jobs=jobs, projection=format_user.projection)
+    with Renderer(fmt, format_user, format_user.projection, color=not no_color) as renderer:
+        for user in users:
+            renderer.row(user)
+    if not renderer.count:
         exit_warning('No data')
-    for i, user in enumerate(data):
-        click.echo('[{}] '.format(i), nl=False)
-        print_user(user)
-        click.echo()
 
 
 @user_group.command()
 @check_privilege('admin')
 @click.argument('email', required=False)
-def print(email):
-    user_api = UserAPI()
+@click.option('--jobs', default=4, type=click.IntRange(1), help='Number of pages fetched in parallel')
+def print(email, jobs):
+    user_api = get_api(UserAPI)
     if not email:
-        data = user_api.list()  # type: List[User]
-        if not data:
+        # The local inventory can only be read from this thread
+        offline = click.get_current_context().obj.get('inventory') is not None
+        user = pick(user_api.iter(jobs=jobs), user_keys, format_user, 'Select an user', background=not offline)
+        if user is None:
             exit_warning('No data')
-        emails = dict()
-        for i, user in enumerate(data):
-            click.echo('[{}] '.format(i), nl=False)
-            print_user(user)
-            click.echo()
-            emails[i] = user.attributes()['email']
-        email = emails[click.prompt('Select an user', type=click.IntRange(0, len(data)))]
-
-    user, error = user_api.from_email(email)
-    if not user:
-        exit_fail('User not found')
+    else:
+        user = user_api.from_email(email)
+        if not user:
+            exit_fail('User not found')
 
     print_user(user, expand=True)
 
@@ -84,20 +93,19 @@ def print(email):
 @click.argument('param')
 @click.argument('value')
 def set(email, param, value):
-    user_api = UserAPI()
+    user_api = get_api(UserAPI)
     user = user_api.from_email(email)  # type: User
     if not user:
         exit_fail('User not found')
-    attrs = user.attributes()
 
-    if not param in attrs:
+    if param not in user:
         exit_fail('Invalid parameter')
     elif user.is_prop_read_only(param):
         exit_fail('The specified parameter is read-only')
 
     prop_type = user.get_prop_type(param).get('type')
     value, error = convert(prop_type, value)
-    if not value:
+    if error:
         exit_fail('Invalid value: {}'.format(error))
 
     ret, error = user_api.patch(user, {param: value})
@@ -111,12 +119,12 @@ def set(email, param, value):
 @check_privilege('rw')
 @click.argument('email')
 def delete(email):
-    user_api = UserAPI()
+    user_api = get_api(UserAPI)
     user = user_api.from_email(email)
     if not user:
         exit_fail('User not found')
 
-    if click.confirm('Do you really want to delete this user?'):
+    if confirm('Do you really want to delete this user?'):
         ret, error = user_api.delete(user)
         if ret:
             click.secho('User deleted', fg='green')
@@ -0,0 +1,394 @@
+"""
+daemon.py : Background process keeping a warm session
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+The daemon runs the command lines of the clients in its own process, where
+the HTTP connections, the decoded token and the schema stay in memory.
+Messages on the Unix socket are frames: a channel byte, a 4 bytes length and the payload.
+Client to daemon:
+* q: the request (JSON), first frame
+* i: a line of the client standard input, empty at the end of the input
+Daemon to client:
+* o / e: standard output / error
+* r: the command waits for a line of the standard input
+* x: exit status of the command (JSON), last frame
+
+This module is the console entry point: it only uses the standard library
+so that proxied invocations start fast.
+"""
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+HEADER = struct.Struct('!cI')
+
+# Commands which always run in the calling process
+LOCAL_COMMANDS = frozenset(('daemon', 'shell', 'auth'))
+
+# Output sent to the client once it is this big, or this old
+SEND_SIZE = 64 * 1024
+SEND_DELAY = 0.05
+
+
+def socket_path() -> Path:
+    path = os.environ.get('EPMANAGE-SOCKET')
+    if path:
+        return Path(path)
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return Path(os.environ['XDG_RUNTIME_DIR']) / 'epmanage.sock'
+    cache = Path(os.environ['XDG_CACHE_HOME']) if os.environ.get('XDG_CACHE_HOME') else Path.home() / '.cache'
+    return cache / 'epmanage' / 'daemon.sock'
+
+
+def send_frame(sock: socket.socket, channel: bytes, data: bytes = b''):
+    sock.sendall(HEADER.pack(channel, len(data)) + data)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data.extend(chunk)
+    return bytes(data)
+
+
+def recv_frame(sock: socket.socket) -> tuple:
+    channel, size = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    return channel, _recv_exactly(sock, size)
+
+
+def connect(path: Optional[Path] = None, timeout: Optional[float] = 1.0) -> Optional[socket.socket]:
+    """Connect to the daemon, if it runs and belongs to the current user"""
+    path = path or socket_path()
+    try:
+        if path.stat().st_uid != os.getuid():
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+    except OSError:
+        return None
+    sock.settimeout(None)
+    return sock
+
+
+def request(sock: socket.socket, data: dict) -> Optional[int]:
+    """
+    Send a request and relay the frames of the answer to the standard streams.
+    Return the exit status, or None if the daemon went away before starting the command
+    """
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    stderr = getattr(sys.stderr, 'buffer', sys.stderr)
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    started = False
+    try:
+        send_frame(sock, b'q', json.dumps(data).encode())
+        while True:
+            channel, payload = recv_frame(sock)
+            started = True
+            if channel == b'o':
+                stdout.write(payload)
+            elif channel == b'e':
+                stderr.write(payload)
+            elif channel == b'r':
+                stdout.flush()
+                stderr.flush()
+                send_frame(sock, b'i', stdin.readline())
+            elif channel == b'x':
+                stdout.flush()
+                stderr.flush()
+                return json.loads(payload.decode())
+    except BrokenPipeError:
+        # Our output was closed (e.g. piped into head)
+        return 1
+    except (OSError, ValueError):
+        if not started:
+            return None
+        sys.stderr.write('Connection to the daemon lost\n')
+        return 1
+    finally:
+        sock.close()
+
+
+def proxy(args: list) -> Optional[int]:
+    """Run a command line in the daemon; None if there is no daemon"""
+    sock = connect()
+    if sock is None:
+        return None
+    return request(sock, dict(
+        args=args,
+        cwd=os.getcwd(),
+        env={key: value for key, value in os.environ.items() if key.startswith('EPMANAGE-')},
+        tty=dict(stdin=sys.stdin.isatty(), stdout=sys.stdout.isatty(), stderr=sys.stderr.isatty())))
+
+
+def main():
+    """Console entry point: go through the daemon when it runs, in process otherwise"""
+    args = sys.argv[1:]
+    if os.environ.get('EPMANAGE-DAEMON', '1') != '0' and not LOCAL_COMMANDS.intersection(args):
+        status = proxy(args)
+        if status is not None:
+            sys.exit(status)
+
+    from epmanage.scripts.cli import cli
+    cli(prog_name='epmanage-cli')
+
+
+class Connection(object):
+    """Output channel to a client, ordered and sent in blocks"""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self._buffer = bytearray()
+        self._sent = time.monotonic()
+        self.closed = False
+
+    def write(self, channel: bytes, data: bytes):
+        self._buffer.extend(HEADER.pack(channel, len(data)) + data)
+        if len(self._buffer) > SEND_SIZE or time.monotonic() - self._sent > SEND_DELAY:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if self.closed:
+            raise BrokenPipeError('The client went away')
+        try:
+            self.sock.sendall(self._buffer)
+        except OSError:
+            self.closed = True
+            raise BrokenPipeError('The client went away')
+        finally:
+            self._buffer.clear()
+            self._sent = time.monotonic()
+
+    def readline(self) -> bytes:
+        self.write(b'r', b'')
+        self.flush()
+        channel, payload = recv_frame(self.sock)
+        if channel != b'i':
+            raise ConnectionError('Unexpected frame')
+        return payload
+
+
+class ClientWriter(object):
+    """Text stream writing on one of the channels of a client"""
+    encoding = 'utf-8'
+    errors = 'strict'
+
+    def __init__(self, connection: Connection, channel: bytes, tty: bool):
+        self._connection = connection
+        self._channel = channel
+        self._tty = tty
+
+    def write(self, text: str) -> int:
+        if not isinstance(text, str):
+            raise TypeError('write() argument must be str')
+        if text:
+            self._connection.write(self._channel, text.encode(self.encoding))
+        return len(text)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self._connection.flush()
+
+    def isatty(self) -> bool:
+        return self._tty
+
+    def writable(self) -> bool:
+        return True
+
+    def readable(self) -> bool:
+        return False
+
+    def fileno(self):
+        raise OSError('No file descriptor')
+
+
+class ClientReader(object):
+    """Text stream reading the standard input of a client on demand"""
+    encoding = 'utf-8'
+    errors = 'strict'
+
+    def __init__(self, connection: Connection, tty: bool):
+        self._connection = connection
+        self._tty = tty
+        self._eof = False
+
+    def readline(self, size: int = -1) -> str:
+        if self._eof:
+            return ''
+        line = self._connection.readline().decode(self.encoding)
+        self._eof = not line
+        return line
+
+    def read(self, size: int = -1) -> str:
+        if size == 0:
+            return ''
+        return ''.join(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def flush(self):
+        pass
+
+    def isatty(self) -> bool:
+        return self._tty
+
+    def readable(self) -> bool:
+        return True
+
+    def fileno(self):
+        raise OSError('No file descriptor')
+
+
+class Daemon(object):
+    """Serve the command lines of the clients, one at a time"""
+
+    def __init__(self, path: Path, idle: float = 3600, schema_refresh: float = 300):
+        self.path = path
+        self.idle = idle
+        self.schema_refresh = schema_refresh
+        self.started = time.time()
+        self.commands = 0
+        self._lock = threading.Lock()
+        self._last = time.monotonic()
+        self._stop = threading.Event()
+
+    def serve(self):
+        from epmanage.lib.schema import schema_registry
+        from epmanage.scripts.utils.runner import install
+        install()
+        schema_registry.max_age = self.schema_refresh
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if connect(self.path) is not None:
+            raise RuntimeError('A daemon already listens on {}'.format(self.path))
+        if self.path.exists():
+            self.path.unlink()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            server.bind(str(self.path))
+        finally:
+            os.umask(umask)
+        server.listen(16)
+        server.settimeout(1)
+        try:
+            while not self._stop.is_set():
+                try:
+                    sock, _ = server.accept()
+                except socket.timeout:
+                    if self.idle and time.monotonic() - self._last > self.idle and not self._lock.locked():
+                        break
+                    continue
+                sock.settimeout(None)
+                threading.Thread(target=self._handle, args=(sock,), daemon=True).start()
+        finally:
+            server.close()
+            try:
+                self.path.unlink()
+            except OSError:
+                pass
+
+    def status(self) -> dict:
+        from epmanage.lib.api import req_sess
+        return dict(
+            pid=os.getpid(),
+            uptime=int(time.time() - self.started),
+            commands=self.commands,
+            transport=req_sess.transport_stats())
+
+    def _handle(self, sock: socket.socket):
+        connection = Connection(sock)
+        try:
+            channel, payload = recv_frame(sock)
+            data = json.loads(payload.decode())
+            if data.get('control') == 'status':
+                connection.write(b'o', (json.dumps(self.status()) + '\n').encode())
+                status = 0
+            elif data.get('control') == 'stop':
+                self._stop.set()
+                status = 0
+            else:
+                with self._lock:
+                    self.commands += 1
+                    status = self._run(connection, data)
+                    self._last = time.monotonic()
+            connection.write(b'x', json.dumps(status).encode())
+            connection.flush()
+        except (OSError, ValueError):
+            pass
+        finally:
+            sock.close()
+
+    @staticmethod
+    def _run(connection: Connection, data: dict) -> int:
+        """Run a command line with the working directory and the environment of the client"""
+        from epmanage.scripts.utils.runner import run_command
+
+        tty = data.get('tty', {})
+        environ = dict(os.environ)
+        cwd = os.getcwd()
+        for key in [x for x in os.environ if x.startswith('EPMANAGE-')]:
+            del os.environ[key]
+        os.environ.update(data.get('env', {}))
+        try:
+            os.chdir(data.get('cwd') or cwd)
+            return run_command(
+                data.get('args', []),
+                stdout=ClientWriter(connection, b'o', tty.get('stdout', False)),
+                stderr=ClientWriter(connection, b'e', tty.get('stderr', False)),
+                stdin=ClientReader(connection, tty.get('stdin', False)))
+        finally:
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+
+
+def control(command: str, path: Optional[Path] = None) -> Optional[str]:
+    """Send a control command (status, stop) to the daemon, return its output"""
+    sock = connect(path)
+    if sock is None:
+        return None
+    output = bytearray()
+    try:
+        send_frame(sock, b'q', json.dumps(dict(control=command)).encode())
+        while True:
+            channel, payload = recv_frame(sock)
+            if channel == b'o':
+                output.extend(payload)
+            elif channel == b'x':
+                return output.decode()
+    except (OSError, ValueError):
+        return None
+    finally:
+        sock.close()
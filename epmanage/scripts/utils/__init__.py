@@ -16,14 +16,18 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
+import re
 import sys
+import time
+from datetime import timedelta
 from functools import update_wrapper
+from pathlib import Path
+from typing import Optional
 
-import arrow
 import click
 
-from epmanage.lib.api import setup_auth
-from epmanage.lib.auth import get_privileges
+# The lib modules (requests, jwt...) are imported on first use, so that
+# commands which do not talk to the server start fast
 
 
 def echo_fail(msg: str):
@@ -48,15 +52,103 @@ def exit_warning(msg: str):
     sys.exit(1)
 
 
+def confirm(text: str) -> bool:
+    """Ask for a confirmation, unless --yes was given"""
+    return click.get_current_context().obj.get('yes') or click.confirm(text)
+
+
+# Tokens already verified by this process (see the daemon), by raw token
+_tokens = dict()
+
+
+def get_token() -> Optional[dict]:
+    """Token of the current invocation, decoded on first use"""
+    obj = click.get_current_context().obj
+    if 'token' not in obj:
+        obj['token'] = None
+        raw_token = obj.get('raw_token')
+        token = _tokens.get(raw_token)
+        if token and token.get('exp', 0) > time.time():
+            obj['token'] = token
+        elif raw_token:
+            import epmanage.lib.auth
+            obj['token'] = epmanage.lib.auth.check_token(raw_token)
+            if obj['token']:
+                _tokens[raw_token] = obj['token']
+    return obj['token']
+
+
+def setup_session():
+    """Apply the global options to the session, cache and inventory, once per invocation"""
+    obj = click.get_current_context().obj
+    if obj.get('session_ready'):
+        return
+    from epmanage.lib.api import req_sess
+    from epmanage.lib.cache import resource_cache, default_cache_dir
+    from epmanage.lib.codec import codec
+    from epmanage.lib.inventory import Inventory
+    from epmanage.lib.schema import schema_registry
+
+    # Every setting is applied, the process may have run other command lines before
+    options = obj['options']
+    obj['session_ready'] = True
+    if codec.use_msgpack(options['msgpack']) != options['msgpack']:
+        echo_warning('msgpack is not installed, using JSON')
+    req_sess.configure(**options['transport'])
+    if options['stats']:
+        from epmanage.lib.metrics import metrics
+        metrics.attach(req_sess)
+        # Close callbacks run in reverse order: the stats are printed, then the samples dropped
+        click.get_current_context().find_root().call_on_close(lambda: metrics.detach(req_sess))
+        click.get_current_context().find_root().call_on_close(
+            lambda mark=metrics.mark(), transport=req_sess.transport_stats():
+            print_stats(options['stats'], mark, transport))
+    req_sess.base_url = options['baseurl']
+    resource_cache.path = Path(options['cache_dir']) if options['cache_dir'] else default_cache_dir()
+    resource_cache.ttl = options['schema_ttl']
+    schema_registry.expire()
+    resource_cache.offline = False
+    inventory = Path(options['inventory']) if options['inventory'] else Path(resource_cache.path) / 'inventory.sqlite'
+    obj['inventory_path'] = inventory
+    if options['offline']:
+        if not inventory.exists():
+            exit_fail('No local inventory, run sync first')
+        obj['inventory'] = Inventory(inventory)
+        click.get_current_context().find_root().call_on_close(obj['inventory'].close)
+        resource_cache.offline = True
+        if not options['baseurl']:
+            req_sess.base_url = obj['inventory'].url or ''
+
+
+def print_stats(fmt: str, since: dict, transport_since: dict):
+    """Print the metrics of the requests sent, and connections opened, since a mark"""
+    import json
+    from epmanage.lib.api import req_sess
+    from epmanage.lib.metrics import metrics
+
+    # The transport counters add up over a daemon's life, only this command's share is shown
+    transport = {key: value - transport_since.get(key, 0) for key, value in req_sess.transport_stats().items()}
+    transport['reused'] = max(0, transport['requests'] - transport['connections'])
+    if fmt == 'json':
+        click.echo(json.dumps(dict(metrics.snapshot(since), transport=transport)), err=True)
+    else:
+        click.echo(metrics.summary(since), err=True)
+        click.echo('connections: {connections} opened, {reused} reused'.format(**transport), err=True)
+
+
 def check_privilege(privilege):
     def decorator(f):
         @click.pass_context
         def new_func(ctx, *args, **kwargs):
-            token = click.get_current_context().obj['token']
+            from epmanage.lib.api import setup_auth
+            from epmanage.lib.auth import get_privileges
+
+            token = get_token()
             if not token:
                 exit_fail('Invalid token')
             if not privilege in get_privileges(token):
                 exit_fail('Insufficient permissions')
+            setup_session()
             setup_auth(click.get_current_context().obj['raw_token'])
             return ctx.invoke(f, *args, **kwargs)
 
@@ -65,20 +157,56 @@ def check_privilege(privilege):
     return decorator
 
 
+class Duration(click.ParamType):
+    """Duration such as 90s, 45m, 12h, 30d or 2w"""
+    name = 'duration'
+    units = dict(s='seconds', m='minutes', h='hours', d='days', w='weeks')
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, timedelta):
+            return value
+        match = re.fullmatch(r'(\d+)([smhdw])', value.strip())
+        if not match:
+            self.fail('{} is not a valid duration (e.g. 30d)'.format(value), param, ctx)
+        return timedelta(**{self.units[match.group(2)]: int(match.group(1))})
+
+
+def get_api(api_cls):
+    """Instantiate an Eve API, reading from the local inventory in offline mode"""
+    api = api_cls()
+    inventory = click.get_current_context().obj.get('inventory')
+    if inventory is not None:
+        api.use_inventory(inventory)
+    return api
+
+
+def projection(*fields):
+    """Declare the fields used by a renderer, so that only them are fetched"""
+    def decorator(f):
+        f.projection = fields
+        return f
+
+    return decorator
+
+
 def convert(prop_type: str, value: str):
     if prop_type == 'string':
         return value, None
     elif prop_type == 'integer':
         try:
-            return int(value)
+            return int(value), None
         except ValueError as exc:
             return None, exc
     elif prop_type == 'boolean':
-        return value.lower() == 'true'
+        return value.lower() == 'true', None
     elif prop_type == 'datetime':
-        return arrow.get(value).isoformat()
+        import arrow
+        try:
+            return arrow.get(value).isoformat(), None
+        except (ValueError, TypeError) as exc:
+            return None, exc
     elif prop_type == 'list':
-        return value.split('|')
+        return value.split('|'), None
     # FIXME: dict
     # FIXME: media
     else:
@@ -0,0 +1,121 @@
+"""
+picker.py : Interactive search and selection of an item
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+from typing import Callable, Iterable, Iterator
+
+import click
+
+from epmanage.lib.search import SearchIndex
+
+HELP = 'Type words to search, a number to select, Enter for the next matches (/TEXT searches for a number)'
+
+
+class Picker(object):
+    """
+    Select an item among the ones yielded by `items`, which are indexed in the background:
+    searching starts with the first page, later pages are added as they arrive.
+    Without `background`, every item is indexed first, in the calling thread
+    (for iterators bound to it, such as the local inventory).
+    `table` formats an item like the list commands: table(attributes, style) -> str
+    """
+
+    def __init__(self, items: Iterator, keys: Callable[[object], Iterable[str]], table: Callable, page: int = 20,
+                 background: bool = True):
+        self.index = SearchIndex(keys)
+        self.table = table
+        self.page = page
+        self.background = background
+        self._items = items
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._done = False
+        self._error = None
+        self._thread = threading.Thread(target=self._load, daemon=True)
+
+    def _load(self):
+        try:
+            for item in self._items:
+                if self._stop.is_set():
+                    break
+                self.index.add(item)
+                self._ready.set()
+        except Exception as exc:
+            self._error = exc
+        finally:
+            close = getattr(self._items, 'close', None)
+            if close:
+                close()
+            self._done = True
+            self._ready.set()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def _show(self, matches: list, start: int):
+        lines = ['[{}] {}'.format(i, self.table(item))
+                 for i, item in enumerate(matches[start:start + self.page], start)]
+        rest = len(matches) - start - len(lines)
+        if rest > 0:
+            lines.append('... {} more match(es)'.format(rest))
+        if not self._done:
+            lines.append('(loading, {} indexed so far)'.format(len(self.index)))
+        click.echo('\n'.join(lines) if matches else 'No match')
+
+    def pick(self, prompt: str = 'Select an item'):
+        """Run the selection, return the chosen item or None if there is nothing to select"""
+        if self.background:
+            self._thread.start()
+        else:
+            self._load()
+        try:
+            self._ready.wait()
+            self._check()
+            if not len(self.index):
+                return None
+
+            click.echo(HELP)
+            query = ''
+            matches = self.index.search(query)
+            start = 0
+            self._show(matches, start)
+            while True:
+                answer = click.prompt(prompt, default='', show_default=False).strip()
+                self._check()
+                if answer.isdigit() and int(answer) < len(matches):
+                    return matches[int(answer)]
+                elif not answer:
+                    # Items loaded since the last search are taken into account
+                    matches = self.index.search(query)
+                    start = start + self.page if start + self.page < len(matches) else 0
+                else:
+                    query = answer[1:] if answer.startswith('/') else answer
+                    matches = self.index.search(query)
+                    start = 0
+                self._show(matches, start)
+        finally:
+            self._stop.set()
+
+
+def pick(items: Iterator, keys: Callable[[object], Iterable[str]], table: Callable, prompt: str = 'Select an item',
+         background: bool = True):
+    """Let the user search and select one of the items"""
+    return Picker(items, keys, table, background=background).pick(prompt)
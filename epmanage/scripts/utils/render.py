@@ -0,0 +1,130 @@
+"""
+render.py : Buffered output of command results
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import csv
+import io
+import json
+import os
+import sys
+import time
+from typing import Callable, Mapping, Optional
+
+import click
+
+FORMATS = ('table', 'json', 'ndjson', 'csv', 'tsv')
+
+# Flush the buffer when it is bigger than this, or older than FLUSH_DELAY seconds
+BUFFER_SIZE = 64 * 1024
+FLUSH_DELAY = 0.2
+
+
+def no_style(text: str, **kwargs) -> str:
+    return text
+
+
+def flatten(value):
+    """Make a value fit in a CSV cell"""
+    if isinstance(value, list):
+        return '|'.join(x.get('name', json.dumps(x)) if isinstance(x, dict) else str(x) for x in value)
+    elif isinstance(value, dict):
+        return json.dumps(value)
+    elif value is None:
+        return ''
+    return value
+
+
+def output_options(f):
+    """Add the --format and --no-color options to a command"""
+    f = click.option('--no-color', is_flag=True, help='Do not use colors in table output')(f)
+    f = click.option('--format', 'fmt', default='table', type=click.Choice(FORMATS), help='Output format')(f)
+    return f
+
+
+class Renderer(object):
+    """
+    Format rows into a buffer written to stdout in large blocks.
+    `table` formats a row for the table output: table(data, style) -> str,
+    machine formats output the `columns` of the raw data
+    """
+
+    def __init__(self, fmt: str = 'table', table: Optional[Callable] = None, columns: tuple = (),
+                 color: bool = True, stream=None):
+        self.fmt = fmt
+        self.table = table
+        self.columns = columns
+        self._stream = stream or click.get_text_stream('stdout')
+        self.style = click.style if color and self._stream.isatty() else no_style
+        self.count = 0
+        self._buffer = io.StringIO()
+        self._flushed = time.monotonic()
+        self._writer = None
+        if fmt in ('csv', 'tsv'):
+            self._writer = csv.writer(self._buffer, delimiter=',' if fmt == 'csv' else '\t', lineterminator='\n')
+            self._writer.writerow(columns)
+        elif fmt == 'json':
+            self._buffer.write('[')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def row(self, data: Mapping):
+        """Output a row: a dict, or an EveItem read in place"""
+        if self.fmt == 'table':
+            self._buffer.write('[{}] '.format(self.count))
+            self._buffer.write(self.table(data, self.style))
+            self._buffer.write('\n')
+        elif self._writer:
+            self._writer.writerow([flatten(data.get(x)) for x in self.columns])
+        else:
+            if self.fmt == 'json':
+                self._buffer.write(',\n' if self.count else '\n')
+            self._buffer.write(json.dumps({x: data.get(x) for x in self.columns}, default=str))
+            if self.fmt == 'ndjson':
+                self._buffer.write('\n')
+        self.count += 1
+
+        if self._buffer.tell() > BUFFER_SIZE or time.monotonic() - self._flushed > FLUSH_DELAY:
+            self.flush()
+
+    def flush(self):
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._flushed = time.monotonic()
+        try:
+            self._stream.write(data)
+            self._stream.flush()
+        except BrokenPipeError:
+            # The reader went away (e.g. piped into head): stop quietly.
+            # Python flushes stdout at exit, point it to devnull so that it does not fail again
+            try:
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, sys.stdout.fileno())
+            except (OSError, ValueError, io.UnsupportedOperation):
+                pass
+            sys.exit(1)
+
+    def close(self):
+        if self.fmt == 'json':
+            self._buffer.write('\n]\n' if self.count else ']\n')
+        self.flush()
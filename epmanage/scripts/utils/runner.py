@@ -0,0 +1,136 @@
+"""
+runner.py : Run command lines inside the current process
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import io
+import sys
+import threading
+import traceback
+from contextlib import contextmanager
+from typing import Optional
+
+import click
+
+
+class StreamProxy(object):
+    """
+    Replacement of sys.stdin/stdout/stderr sending each thread to its own stream,
+    the original one by default
+    """
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    @property
+    def target(self):
+        return getattr(self._local, 'stream', None) or self._default
+
+    def redirect(self, stream):
+        self._local.stream = stream
+
+    # click wraps text streams without an encoding, answer for the target
+    @property
+    def encoding(self):
+        return getattr(self.target, 'encoding', None) or 'utf-8'
+
+    @property
+    def errors(self):
+        return getattr(self.target, 'errors', None) or 'strict'
+
+    def __getattr__(self, item):
+        return getattr(self.target, item)
+
+    def __iter__(self):
+        return iter(self.target)
+
+
+class Capture(io.StringIO):
+    """In-memory output of a command"""
+    encoding = 'utf-8'
+    errors = 'strict'
+
+
+def install():
+    """Put the stream proxies in place, once per process"""
+    for name in ('stdin', 'stdout', 'stderr'):
+        if not isinstance(getattr(sys, name), StreamProxy):
+            setattr(sys, name, StreamProxy(getattr(sys, name)))
+
+
+@contextmanager
+def redirect(stdout=None, stderr=None, stdin=None):
+    """Redirect the standard streams of the current thread"""
+    install()
+    streams = dict(stdin=stdin, stdout=stdout, stderr=stderr)
+    previous = {name: getattr(sys, name)._local.__dict__.get('stream') for name in streams}
+    for name, stream in streams.items():
+        getattr(sys, name).redirect(stream)
+    try:
+        yield
+    finally:
+        for name, stream in previous.items():
+            getattr(sys, name).redirect(stream)
+
+
+def exit_code(code) -> int:
+    if code is None:
+        return 0
+    elif isinstance(code, int):
+        return code
+    click.echo(code, err=True)
+    return 1
+
+
+def run_command(args: list, stdout=None, stderr=None, stdin=None) -> int:
+    """
+    Run a command line as the epmanage-cli executable would, and return its exit status.
+    The given streams replace the standard ones for the current thread only
+    """
+    from epmanage.scripts.cli import cli
+
+    with redirect(stdout, stderr, stdin if stdin is not None else (io.StringIO() if stdout else None)):
+        try:
+            cli.main(args, prog_name='epmanage-cli', standalone_mode=True)
+        except SystemExit as exc:
+            return exit_code(exc.code)
+        except Exception:
+            try:
+                traceback.print_exc()
+            except OSError:
+                pass
+            return 1
+    return 0
+
+
+def global_args(ctx: Optional[click.Context] = None) -> list:
+    """Global options given on the command line of the current invocation"""
+    root = (ctx or click.get_current_context()).find_root()
+    args = []
+    for param in root.command.params:
+        if not isinstance(param, click.Option) or root.get_parameter_source(param.name) != \
+                click.core.ParameterSource.COMMANDLINE:
+            continue
+        value = root.params[param.name]
+        if param.is_flag:
+            if value:
+                args.append(param.opts[0])
+        else:
+            args.extend((param.opts[0], str(value)))
+    return args
@@ -24,18 +24,24 @@ from setuptools import setup, find_packages
 setup(
     name='epmanage-cli',
     version='0.0.1',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     include_package_data=True,
+    python_requires='>=3.7',
     install_requires=[
-        'Click',
-        'requests',
+        'Click>=8.0',  # click.core.ParameterSource, FloatRange(min_open=...)
+        'requests>=2.27',  # requests.exceptions.JSONDecodeError
         'jwt',
         'arrow',
-        'pandas',
+        'pandas>=1.1',  # groupby(dropna=False)
     ],
+    extras_require={
+        'async': ['aiohttp>=3.3'],  # ClientTimeout
+        'parquet': ['pyarrow'],
+        'speedups': ['orjson', 'msgpack', 'brotli'],
+    },
     entry_points='''
         [console_scripts]
-        epmanage-cli=epmanage.scripts.cli:cli
+        epmanage-cli=epmanage.scripts.daemon:main
     ''',
     # The project's main homepage.
     url='https://github.com/PokeSec/epmanage-cli',
@@ -64,6 +70,13 @@ setup(
 
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
     ],
 )